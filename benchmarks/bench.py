@@ -0,0 +1,206 @@
+"""
+End-to-end benchmarks for the Discover Daily pipeline against a local fake Spotify API.
+
+Usage: python -m benchmarks.bench --tracks 10000 --latency 0.02 --throttle-rate 0.01
+       python -m benchmarks.bench --tracks 10000 --save       (record the results as the baseline)
+
+Reports wall time, API calls per endpoint, SQLite statements and peak Python memory for each
+pipeline stage, and exits non-zero if a stage regressed against the stored baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+import spotipy
+
+import discoverdaily
+from discoverdaily import DBConnection, SPConnection, SPClient
+from utils.ratelimit import TokenBucket
+from benchmarks.fake_spotify import FakeLibrary, FakeSpotifyServer
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+DISLIKED_PLAYLIST = '6sd1N50ZULzrgoWX0ViDwC'
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def __call__(self, *args):
+        self.value += 1
+
+def measure(results, name, server, f):
+    statements = Counter()
+    DBConnection.trace = statements
+    if DBConnection.db:
+        DBConnection.db.set_trace_callback(statements)
+
+    calls = dict(server.calls)
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+
+    value = f()
+
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    api = {endpoint: n - calls.get(endpoint, 0) for endpoint, n in server.calls.items() if n - calls.get(endpoint, 0)}
+
+    results[name] = {
+        'wall_s': round(wall, 4),
+        'api_calls': sum(api.values()),
+        'api': api,
+        'db_statements': statements.value,
+        'peak_kb': round(peak / 1024),
+    }
+    return value
+
+def run(args):
+    server = FakeSpotifyServer(FakeLibrary(args.tracks, seed=args.seed), latency=args.latency,
+                               throttle_rate=args.throttle_rate, retry_after=args.retry_after).start()
+    workdir = tempfile.mkdtemp(prefix='discoverdaily-bench-')
+    cwd = os.getcwd()
+    results = {}
+
+    try:
+        os.chdir(workdir)
+        DBConnection.path = os.path.join(workdir, 'records.db')
+        if args.rate:
+            SPClient.bucket = TokenBucket(rate=args.rate, capacity=args.rate * 2)
+
+        sp = spotipy.Spotify(auth='benchmark', requests_session=SPConnection().get_session())
+        sp.prefix = server.prefix
+        SPConnection.sp = sp
+
+        # Injected 429s are expected; keep spotipy from logging every one of them
+        logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+
+        # discoverdaily imports these lazily; load them first so no stage is charged for the import
+        import joblib, sklearn.tree, sklearn.ensemble, sklearn.model_selection, sklearn.metrics, sklearn.neighbors
+        tracemalloc.start()
+
+        def sync():
+            discoverdaily.db_migrate()
+            discoverdaily.TrackIndex().load()
+            discoverdaily.load_saved_tracks()
+            discoverdaily.load_playlist_tracks(playlist_id=DISLIKED_PLAYLIST, liked=0)
+
+        measure(results, 'sync_cold', server, sync)
+        measure(results, 'sync_warm', server, sync)
+        ids, x, y = measure(results, 'load', server, discoverdaily.db_load_matrix)
+        model, score, trained = measure(results, 'train', server, lambda: discoverdaily.train_model(ids, x, y, discoverdaily.DATA_FEATURES, *discoverdaily.model_choice(args.model)))
+        taste = discoverdaily.load_taste_index(ids, x, y)
+
+        def recommend():
+            # Candidates are fetched and scored together, so the stream can stop as soon as the playlist is full
+            batches = discoverdaily.get_recommendations(seeds=discoverdaily.db_select_seed_artists(n=10),
+                                                        max_artists=max(discoverdaily.WALK_ARTISTS, args.playlist_length))
+            return discoverdaily.stream_candidates(model, taste, batches, args.playlist_length)
+
+        choices, scores = measure(results, 'candidates', server, recommend)
+
+        def publish():
+            discoverdaily.publish_playlist(title='Discover Daily Benchmark', description='', tracks=choices, replace=not args.new_playlist)
+
+        measure(results, 'publish', server, publish)
+
+        def main():
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                discoverdaily.main(args.playlist_length, 'benchmark', '', '', '', headless=True,
+                                   model=args.model, replace_playlist=not args.new_playlist)
+
+        measure(results, 'main', server, main)
+
+        tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+        SPConnection().close_cache()
+        DBConnection().close_connection()
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results['total'] = {
+        'wall_s': round(sum(stage['wall_s'] for stage in results.values()), 4),
+        'api_calls': sum(stage['api_calls'] for stage in results.values()),
+        'throttles': server.throttles,
+        'db_statements': sum(stage['db_statements'] for stage in results.values()),
+        'peak_kb': max(stage['peak_kb'] for stage in results.values()),
+    }
+    return results
+
+def compare(results, baseline, tolerance):
+    # Wall time and memory get a relative tolerance; API calls and statements are deterministic enough to compare strictly
+    regressions = []
+    for stage, metrics in results.items():
+        base = baseline.get(stage)
+        if not base:
+            continue
+
+        if metrics['wall_s'] > base['wall_s'] * (1 + tolerance) + 0.05:
+            regressions.append(f"{stage}: wall time {metrics['wall_s']}s vs {base['wall_s']}s")
+        if metrics['peak_kb'] > base['peak_kb'] * (1 + tolerance) + 256:
+            regressions.append(f"{stage}: peak memory {metrics['peak_kb']}KB vs {base['peak_kb']}KB")
+        if metrics['api_calls'] > base['api_calls'] * (1 + tolerance):
+            regressions.append(f"{stage}: {metrics['api_calls']} API calls vs {base['api_calls']}")
+        if metrics['db_statements'] > base['db_statements'] * (1 + tolerance):
+            regressions.append(f"{stage}: {metrics['db_statements']} DB statements vs {base['db_statements']}")
+
+    return regressions
+
+def report(results):
+    print(f"{'stage':<12}{'wall (s)':>10}{'API calls':>11}{'DB stmts':>10}{'peak (KB)':>11}  API calls by endpoint")
+    for stage, metrics in results.items():
+        endpoints = ', '.join(f'{endpoint}={n}' for endpoint, n in sorted(metrics.get('api', {}).items()))
+        print(f"{stage:<12}{metrics['wall_s']:>10.3f}{metrics['api_calls']:>11}{metrics['db_statements']:>10}{metrics['peak_kb']:>11}  {endpoints}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Discover Daily pipeline against a local fake Spotify API')
+    parser.add_argument('--tracks', type=int, default=1000, help='Saved tracks in the synthetic library (1k - 500k)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added to every API request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of API requests answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After seconds sent with each 429')
+    parser.add_argument('--rate', type=float, default=None, help='Override the client token bucket rate (requests/second)')
+    parser.add_argument('--playlist-length', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', default=discoverdaily.MODEL, choices=['tree', 'hist_gb', 'knn'], help='Classifier trained by the train and main stages')
+    parser.add_argument('--new-playlist', action='store_true', help="Publish to a new playlist each time instead of replacing the last one")
+    parser.add_argument('--baseline', default=BASELINES, help='Baseline file to compare against and save to')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression before failing')
+    parser.add_argument('--save', action='store_true', help='Store these results as the baseline for this scenario')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    scenario = f'tracks={args.tracks},latency={args.latency},throttle_rate={args.throttle_rate}'
+    if args.model != discoverdaily.MODEL:
+        scenario += f',model={args.model}'
+    results = run(args)
+
+    if args.json:
+        print(json.dumps({scenario: results}, indent=4))
+    else:
+        print(scenario)
+        report(results)
+
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+
+    if args.save:
+        baselines[scenario] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+        print(f'Baseline saved to {args.baseline}')
+
+    elif scenario in baselines:
+        regressions = compare(results, baselines[scenario], args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
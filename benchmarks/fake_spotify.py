@@ -0,0 +1,259 @@
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FEATURES = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'speechiness', 'valence']
+
+class FakeLibrary:
+    """
+    A deterministic, synthetic Spotify catalog and user library.
+
+    Every track, artist and feature vector is derived from its index, so libraries of
+    any size (1k - 500k tracks) cost no memory until they are requested.
+
+    Args: tracks (saved tracks), disliked (tracks in the disliked playlist), seed
+    """
+
+    def __init__(self, tracks=1000, disliked=None, seed=0):
+        self.tracks = tracks
+        self.disliked = tracks // 4 if disliked is None else disliked
+        self.artists = max(50, tracks // 20)
+        self.seed = seed
+        self.added = datetime(2024, 1, 1)
+        self.playlists = {}
+
+    def track_id(self, index):
+        return f'T{index:021d}'
+
+    def artist_id(self, index):
+        return f'A{index % self.artists:021d}'
+
+    def track(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        artists = [self.artist_id(rng.randrange(self.artists)) for _ in range(rng.choice([1, 1, 2]))]
+
+        return {
+            'id': self.track_id(index),
+            'name': f'Track {index}',
+            'popularity': rng.randrange(100),
+            'artists': [{'id': artist_id, 'name': f'Artist {int(artist_id[1:])}'} for artist_id in artists],
+        }
+
+    def features(self, track_id):
+        rng = random.Random(f'{self.seed}:{track_id}')
+        features = {name: rng.random() for name in FEATURES}
+        features.update({
+            'id': track_id,
+            'duration_ms': rng.randrange(90000, 420000),
+            'key': rng.randrange(12),
+            'loudness': rng.uniform(-30, 0),
+            'mode': rng.randrange(2),
+            'tempo': rng.uniform(60, 200),
+            'time_signature': rng.choice([3, 4, 4, 4, 5]),
+        })
+        return features
+
+    def saved_page(self, offset, limit):
+        indexes = range(offset, min(offset + limit, self.tracks))
+        items = [{'added_at': (self.added - timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ'), 'track': self.track(i)} for i in indexes]
+        return page(items, offset, limit, self.tracks)
+
+    def disliked_page(self, offset, limit):
+        indexes = range(offset, min(offset + limit, self.disliked))
+        items = [{'track': self.track(self.tracks + i)} for i in indexes]
+        return page(items, offset, limit, self.disliked)
+
+    def related_artists(self, artist_id):
+        rng = random.Random(f'{self.seed}:{artist_id}')
+        return {'artists': [{'id': self.artist_id(rng.randrange(self.artists)), 'name': 'Related'} for _ in range(20)]}
+
+    def top_tracks(self, artist_id):
+        # Top tracks come from the wider catalog, mostly outside the user's library
+        rng = random.Random(f'{self.seed}:top:{artist_id}')
+        return {'tracks': [self.track(self.tracks + self.disliked + rng.randrange(self.artists * 50)) for _ in range(10)]}
+
+def page(items, offset, limit, total):
+    return {'items': items, 'offset': offset, 'limit': limit, 'total': total,
+            'next': 'next' if offset + limit < total else None}
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the Spotify Web API endpoints used by discoverdaily.py.
+
+    Usage: server = FakeSpotifyServer(FakeLibrary(10000), latency=0.02, throttle_rate=0.01)
+           server.start(); point spotipy's `prefix` at server.prefix; server.stop()
+    Args: library, latency (seconds added to every request), throttle_rate (share of requests answered with 429),
+          retry_after (seconds sent in the Retry-After header)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, library, latency=0.0, throttle_rate=0.0, retry_after=1, port=0):
+        super().__init__(('127.0.0.1', port), FakeSpotifyHandler)
+        self.library = library
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.calls = {}
+        self.throttles = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random(library.seed)
+
+    @property
+    def prefix(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1/'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            throttled = self.rng.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+        return throttled
+
+ROUTES = [
+    ('GET', r'me/?', 'me'),
+    ('GET', r'me/tracks', 'saved_tracks'),
+    ('GET', r'me/playlists', 'my_playlists'),
+    ('GET', r'audio-features/?', 'audio_features'),
+    ('GET', r'artists/(?P<id>\w+)/related-artists', 'related_artists'),
+    ('GET', r'artists/(?P<id>\w+)/top-tracks', 'top_tracks'),
+    ('GET', r'playlists/(?P<id>\w+)', 'playlist'),
+    ('GET', r'playlists/(?P<id>\w+)/(tracks|items)', 'playlist_items'),
+    ('POST', r'playlists/(?P<id>\w+)/(tracks|items)', 'playlist_add'),
+    ('PUT', r'playlists/(?P<id>\w+)/(tracks|items)', 'playlist_replace'),
+    ('PUT', r'playlists/(?P<id>\w+)', 'playlist_details'),
+    ('GET', r'playlists/(?P<id>\w+)/followers/contains', 'playlist_following'),
+    ('POST', r'users/(?P<user>\w+)/playlists', 'playlist_create'),
+]
+
+RESPONDED = object()
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def route(self, method):
+        url = urlparse(self.path)
+        path = url.path[len('/v1/'):]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        for route_method, pattern, endpoint in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, {'error': {'status': 404, 'message': f'No fake for {method} {path}'}})
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.count(endpoint):
+            return self.respond(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                headers={'Retry-After': str(self.server.retry_after)})
+
+        # Endpoints return the 200 payload, or answer an error themselves with `return self.respond(...)`
+        payload = getattr(self, endpoint)(query, body, **match.groupdict())
+        if payload is not RESPONDED:
+            self.respond(200, payload)
+
+    def respond(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        return RESPONDED
+
+    # ----------------------------------------------------------------
+
+    def me(self, query, body):
+        return {'id': 'benchmark', 'display_name': 'Benchmark User'}
+
+    def saved_tracks(self, query, body):
+        return self.server.library.saved_page(int(query.get('offset', 0)), int(query.get('limit', 20)))
+
+    def my_playlists(self, query, body):
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 50))
+        playlists = [{'id': playlist_id, 'name': playlist['name'], 'owner': {'id': 'benchmark'}}
+                     for playlist_id, playlist in self.server.library.playlists.items()]
+        return page(playlists[offset:offset + limit], offset, limit, len(playlists))
+
+    def audio_features(self, query, body):
+        ids = query.get('ids', '').split(',')
+        if len(ids) > 100:
+            return self.respond(400, {'error': {'status': 400, 'message': 'Too many ids requested'}})
+        return {'audio_features': [self.server.library.features(track_id) for track_id in ids]}
+
+    def related_artists(self, query, body, id):
+        return self.server.library.related_artists(id)
+
+    def top_tracks(self, query, body, id):
+        return self.server.library.top_tracks(id)
+
+    def playlist(self, query, body, id):
+        library = self.server.library
+        if id in library.playlists:
+            return {'id': id, 'snapshot_id': str(len(library.playlists[id]['uris'])), 'name': library.playlists[id]['name']}
+        return {'id': id, 'snapshot_id': f'disliked-{library.disliked}'}
+
+    def playlist_items(self, query, body, id):
+        return self.server.library.disliked_page(int(query.get('offset', 0)), int(query.get('limit', 100)))
+
+    def playlist_add(self, query, body, id):
+        uris = body['uris'] if isinstance(body, dict) else body
+        playlist = self.server.library.playlists.setdefault(id, {'name': id, 'uris': []})
+        position = int(query.get('position', len(playlist['uris'])))
+        playlist['uris'][position:position] = uris
+        return {'snapshot_id': str(len(playlist['uris']))}
+
+    def playlist_replace(self, query, body, id):
+        playlist = self.server.library.playlists.setdefault(id, {'name': id, 'uris': []})
+        playlist['uris'] = list(body['uris'])
+        return {'snapshot_id': str(len(playlist['uris']))}
+
+    def playlist_details(self, query, body, id):
+        playlist = self.server.library.playlists.setdefault(id, {'name': id, 'uris': []})
+        playlist['name'] = body.get('name', playlist['name'])
+        return None
+
+    def playlist_following(self, query, body, id):
+        # Created playlists are followed by their owner; mark one 'unfollowed' to act out the user deleting it
+        followed = id in self.server.library.playlists and not self.server.library.playlists[id].get('unfollowed')
+        return [followed for _ in query.get('ids', '').split(',')]
+
+    def playlist_create(self, query, body, user):
+        playlist_id = f'P{len(self.server.library.playlists):021d}'
+        self.server.library.playlists[playlist_id] = {'name': body['name'], 'uris': []}
+        return {'id': playlist_id, 'name': body['name']}
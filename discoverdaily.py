@@ -1,137 +1,530 @@
 import os
 import sys
+import json
+import time
+import hashlib
+import zlib
+import math
 import argparse
 from datetime import datetime
 import random
+import atexit
+import threading
+from contextlib import contextmanager, nullcontext
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from utils.utilities import my_print as print
 from utils.utilities import my_input as input
 from utils.utilities import ProgressBar, CountDown, print_json
+from utils.cache import TTLCache
+from utils.ratelimit import TokenBucket, AdaptiveLimiter
+from utils.metrics import Metrics
+from utils.profiling import Profiler
 
-import spotipy
-import spotipy.util
-from spotipy.oauth2 import SpotifyClientCredentials
-from spotipy.client import SpotifyException
-import spotipy.oauth2 as oauth2
-
-import pandas as pd
+import numpy as np
 import sqlite3
 from sqlite3 import Error
 
-from sklearn import tree
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
+# spotipy, requests, sklearn and joblib are imported where they are used,
+# so a subcommand (or the scheduler) only pays the import time of what it runs
 
 # ----------------------------------------------------------------
 
+class DBConnection:
+    path = 'records.db'
+    db = None
+    lock = threading.RLock()
+    trace = None
+
+    def get_connection(self):
+        with DBConnection.lock:
+            if not DBConnection.db:
+                DBConnection.db = db_create_connection(DBConnection.path)
+            return DBConnection.db
+
+    def close_connection(self):
+        with DBConnection.lock:
+            if DBConnection.db:
+                DBConnection.db.close()
+                DBConnection.db = None
+
+    def data_path(self, *names):
+        # Caches and models live next to the database, so each records.db gets its own
+        return os.path.join(os.path.dirname(DBConnection.path), *names)
+
+    @contextmanager
+    def transaction(self):
+        # Commits on success, rolls back on error, and keeps other threads out until done.
+        # Used by the writes that span several statements (or tables), so none of them is left half applied
+        with DBConnection.lock:
+            db = self.get_connection()
+            with db:
+                yield db
+
+atexit.register(DBConnection().close_connection)
+
 def db_connection(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        db = db_create_connection('records.db')
-        return f(*args, **kwargs, db=db)
+        with DBConnection.lock:
+            db = DBConnection().get_connection()
+            return f(*args, **kwargs, db=db)
 
     return wrapper
 
 def db_create_connection(db_file):
     try:
-        connection = sqlite3.connect(db_file)
+        # One long-lived handle shared by every db_* call (serialized by DBConnection.lock)
+        connection = sqlite3.connect(db_file, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.execute('PRAGMA cache_size = -16000')
+        connection.execute('PRAGMA temp_store = MEMORY')
+        connection.execute('PRAGMA busy_timeout = 5000')
+        connection.set_trace_callback(DBConnection.trace)
         return connection
     except Error as e:
         print('Error: ' + str(e), color='red')
         return None
 
+# ----------------------------------------------------------------
+# records.db carries its schema version in PRAGMA user_version. MIGRATIONS[n] takes it from version n to n + 1,
+# and db_migrate runs whichever are missing, each in one transaction together with its version bump.
+
+def migrate_tables(db):
+    # Version 1: the tables as they were before the schema was versioned (kept as is for existing databases)
+    db.execute(""" CREATE TABLE IF NOT EXISTS tracks (
+                       id TEXT UNIQUE PRIMARY KEY,
+                       name TEXT NOT NULL,
+                       artist1 TEXT NOT NULL,
+                       artist1ID TEXT NOT NULL,
+                       artist2 TEXT,
+                       artist2ID TEXT,
+                       popularity INTEGER NOT NULL,
+                       liked BOOLEAN NOT NULL,
+                       acousticness DECIMAL(1, 5) NOT NULL,
+                       danceability DECIMAL(1, 5) NOT NULL,
+                       duration_ms  INTEGER NOT NULL,
+                       energy DECIMAL(1, 5) NOT NULL,
+                       instrumentalness DECIMAL(1, 5) NOT NULL,
+                       key INTEGER NOT NULL,
+                       liveness DECIMAL(1, 5) NOT NULL,
+                       loudness INTEGER NOT NULL,
+                       mode INTEGER NOT NULL,
+                       speechiness DECIMAL(1, 5) NOT NULL,
+                       valence DECIMAL(1, 5) NOT NULL,
+                       tempo INTEGER NOT NULL,
+                       time_signature INTEGER NOT NULL
+                   );
+               """)
+    db.execute(""" CREATE TABLE IF NOT EXISTS sync_state (
+                       source TEXT PRIMARY KEY,
+                       cursor TEXT NOT NULL,
+                       updated_at TEXT NOT NULL
+                   );
+               """)
+    db.execute(f""" CREATE TABLE IF NOT EXISTS audio_features (
+                        id TEXT PRIMARY KEY,
+                        {', '.join(f'{column} REAL NOT NULL' for column in FEATURE_COLUMNS)}
+                    );
+                """)
+    db.execute(""" CREATE TABLE IF NOT EXISTS artist_graph (
+                       artist_id TEXT NOT NULL,
+                       related_id TEXT NOT NULL,
+                       rank INTEGER NOT NULL,
+                       PRIMARY KEY (artist_id, related_id)
+                   );
+               """)
+    db.execute(""" CREATE TABLE IF NOT EXISTS artist_fetched (
+                       artist_id TEXT PRIMARY KEY,
+                       fetched_at REAL NOT NULL
+                   );
+               """)
+
+def migrate_artists(db):
+    # Version 2: REAL audio features, any number of artists per track (in artists and track_artists),
+    # and indexes for the reads that filter on liked or on an artist
+    columns = ', '.join(FEATURE_COLUMNS)
+    db.execute(f""" CREATE TABLE tracks_v2 (
+                        id TEXT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        popularity INTEGER NOT NULL,
+                        liked INTEGER NOT NULL,
+                        {', '.join(f'{column} {"INTEGER" if column in INTEGER_FEATURES else "REAL"} NOT NULL' for column in FEATURE_COLUMNS)}
+                    );
+                """)
+    # Copied in rowid order, so tracks keep their relative order for the matrix cache
+    db.execute(f'INSERT INTO tracks_v2 (id, name, popularity, liked, {columns}) SELECT id, name, popularity, liked, {columns} FROM tracks ORDER BY rowid')
+
+    db.execute(""" CREATE TABLE artists (
+                       id TEXT PRIMARY KEY,
+                       name TEXT NOT NULL
+                   );
+               """)
+    db.execute(""" CREATE TABLE track_artists (
+                       track_id TEXT NOT NULL,
+                       artist_id TEXT NOT NULL,
+                       position INTEGER NOT NULL,
+                       PRIMARY KEY (track_id, position)
+                   );
+               """)
+    db.execute(""" INSERT OR IGNORE INTO artists (id, name)
+                   SELECT artist1ID, artist1 FROM tracks
+                   UNION ALL SELECT artist2ID, artist2 FROM tracks WHERE artist2ID IS NOT NULL
+               """)
+    db.execute(""" INSERT INTO track_artists (track_id, artist_id, position)
+                   SELECT id, artist1ID, 0 FROM tracks
+                   UNION ALL SELECT id, artist2ID, 1 FROM tracks WHERE artist2ID IS NOT NULL
+               """)
+
+    db.execute('DROP TABLE tracks')
+    db.execute('ALTER TABLE tracks_v2 RENAME TO tracks')
+    db.execute('CREATE INDEX tracks_liked ON tracks (liked)')
+    db.execute('CREATE INDEX track_artists_artist ON track_artists (artist_id)')
+
+def migrate_import_pages(db):
+    # Version 3: pages finished by an interrupted bulk import, so the next sync resumes it
+    db.execute(""" CREATE TABLE import_pages (
+                       source TEXT NOT NULL,
+                       generation TEXT NOT NULL,
+                       page_offset INTEGER NOT NULL,
+                       PRIMARY KEY (source, page_offset)
+                   );
+               """)
+
+MIGRATIONS = [migrate_tables, migrate_artists, migrate_import_pages]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+@db_connection
+def db_migrate(db=None):
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            with db:
+                db.execute('BEGIN')
+                migration(db)
+                db.execute(f'PRAGMA user_version = {number}')
+        except Error as e:
+            print(f'Error migrating records.db to version {number}: ' + str(e), color='red')
+            raise
+
+    return max(version, SCHEMA_VERSION)
+
 @db_connection
-def db_create_table(db=None, table_name='tracks'):
+def db_insert_tracks(db=None, tracks=None):
+    # tracks is a TRACK_DTYPE record array
     try:
-        statement = f""" CREATE TABLE IF NOT EXISTS {table_name} (
-                            id TEXT UNIQUE PRIMARY KEY,
-
-                            name TEXT NOT NULL,
-                            artist1 TEXT NOT NULL,
-                            artist1ID TEXT NOT NULL,
-                            artist2 TEXT,
-                            artist2ID TEXT,
-                            popularity INTEGER NOT NULL,
-                            liked BOOLEAN NOT NULL,
-
-                            acousticness DECIMAL(1, 5) NOT NULL,
-                            danceability DECIMAL(1, 5) NOT NULL,
-                            duration_ms  INTEGER NOT NULL,
-                            energy DECIMAL(1, 5) NOT NULL,
-                            instrumentalness DECIMAL(1, 5) NOT NULL,
-                            key INTEGER NOT NULL,
-                            liveness DECIMAL(1, 5) NOT NULL,
-                            loudness INTEGER NOT NULL,
-                            mode INTEGER NOT NULL,
-                            speechiness DECIMAL(1, 5) NOT NULL,
-                            valence DECIMAL(1, 5) NOT NULL,
-                            tempo INTEGER NOT NULL,
-                            time_signature INTEGER NOT NULL
-                        );
+        statement = f""" INSERT OR IGNORE INTO tracks ({", ".join(TRACK_COLUMNS)})
+                        VALUES({", ".join("?" * len(TRACK_COLUMNS))});
                     """
-        cursor = db.cursor()
-        cursor.execute(statement)
-        db.commit()
+        artists, track_artists = artist_rows(tracks)
+        with DBConnection().transaction():
+            cursor = db.executemany(statement, track_rows(tracks))
+            inserted = cursor.rowcount
+            db.executemany('INSERT INTO artists (id, name) VALUES(?, ?) ON CONFLICT(id) DO UPDATE SET name = excluded.name', artists)
+            db.executemany('INSERT OR IGNORE INTO track_artists (track_id, artist_id, position) VALUES(?, ?, ?)', track_artists)
+        TrackIndex().add(tracks['id'])
+        return inserted
     except Error as e:
         print('Error: ' + str(e), color='red')
 
 @db_connection
-def db_has_track(db=None, track_id=None):
+def db_get_known(db=None):
+    # Every track id in the library as one sorted S22 array (22 bytes a track, no per-row objects)
+    try:
+        cursor = db.execute('SELECT id FROM tracks')
+        return np.sort(np.fromiter((row[0] for row in cursor), dtype='S22'))
+
+    except Error as e:
+        print('Error: ' + str(e), color='red')
+        return np.empty(0, dtype='S22')
+
+class TrackIndex:
+    # Known ids are a sorted array searched by bisection; ids added since are kept in a set
+    # and merged into the array once there are `merge_after` of them
+    ids = None
+    added = set()
+    merge_after = 10000
+
+    def load(self):
+        TrackIndex.ids = db_get_known()
+        TrackIndex.added = set()
+
+    def has(self, track_id):
+        return not self.missing([track_id])
+
+    def missing(self, track_ids):
+        # The ids not in the library, found with one vectorized search for the whole batch
+        if TrackIndex.ids is None:
+            self.load()
+
+        keys = np.array(track_ids, dtype='S22')
+        if len(TrackIndex.ids):
+            i = np.searchsorted(TrackIndex.ids, keys).clip(max=len(TrackIndex.ids) - 1)
+            known = TrackIndex.ids[i] == keys
+        else:
+            known = np.zeros(len(keys), dtype=bool)
+
+        return [track_id for track_id, key, found in zip(track_ids, keys.tolist(), known.tolist())
+                if not found and key not in TrackIndex.added]
+
+    def add(self, ids):
+        if TrackIndex.ids is not None:
+            TrackIndex.added.update(ids.tolist())
+            if len(TrackIndex.added) >= TrackIndex.merge_after:
+                TrackIndex.ids = np.union1d(TrackIndex.ids, np.array(list(TrackIndex.added), dtype='S22'))
+                TrackIndex.added = set()
+
+@db_connection
+def db_get_sync_state(db=None, source=None):
     cursor = db.cursor()
-    cursor.execute('SELECT count(*) FROM tracks WHERE id = ?', (track_id,))
-    data = cursor.fetchone()[0]
+    cursor.execute('SELECT cursor FROM sync_state WHERE source = ?', (source,))
+    row = cursor.fetchone()
 
-    if data == 0:
-        return False
-    return True
+    if row:
+        return row[0]
+    return None
 
 @db_connection
-def db_insert_track(db=None, track=None):
+def db_set_sync_state(db=None, source=None, value=None):
     try:
-        statement = """ INSERT INTO tracks (id, name, artist1, artist1ID, artist2, artist2ID, 
-                                            popularity, liked, 
-                                            acousticness, danceability, duration_ms, energy, instrumentalness, 
-                                            key, liveness, loudness, mode, speechiness, valence, tempo, time_signature)
-                        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        statement = """ INSERT INTO sync_state (source, cursor, updated_at)
+                        VALUES(?, ?, ?)
+                        ON CONFLICT(source) DO UPDATE SET cursor = excluded.cursor, updated_at = excluded.updated_at;
                     """
-        cursor = db.cursor()
-        cursor.execute(statement, track)
-        db.commit()
-        return cursor.lastrowid
+        with db:
+            db.execute(statement, (source, value, datetime.now().isoformat()))
     except Error as e:
         print('Error: ' + str(e), color='red')
 
 @db_connection
-def db_select_track(db=None, liked=None):
+def db_start_import(db=None, source=None, generation=None):
+    # Offsets already imported for this generation of the source; pages from an older one are forgotten
     try:
-        statement = """ SELECT *
-                        FROM tracks
-                        WHERE liked = ?
-                    """
+        with DBConnection().transaction():
+            db.execute('DELETE FROM import_pages WHERE source = ? AND generation != ?', (source, generation))
+            return {row[0] for row in db.execute('SELECT page_offset FROM import_pages WHERE source = ?', (source,))}
+    except Error as e:
+        print('Error: ' + str(e), color='red')
+        return set()
+
+@db_connection
+def db_mark_imported(db=None, source=None, generation=None, offset=None):
+    try:
+        with db:
+            db.execute('INSERT OR IGNORE INTO import_pages (source, generation, page_offset) VALUES(?, ?, ?)', (source, generation, offset))
+    except Error as e:
+        print('Error: ' + str(e), color='red')
+
+@db_connection
+def db_finish_import(db=None, source=None):
+    try:
+        with db:
+            db.execute('DELETE FROM import_pages WHERE source = ?', (source,))
+    except Error as e:
+        print('Error: ' + str(e), color='red')
+
+FEATURE_COLUMNS = ['acousticness', 'danceability', 'duration_ms', 'energy', 'instrumentalness', 'key',
+                   'liveness', 'loudness', 'mode', 'speechiness', 'valence', 'tempo', 'time_signature']
+INTEGER_FEATURES = ['duration_ms', 'key', 'mode', 'time_signature']
+
+DATA_FEATURES = ['popularity', 
+                 'danceability', 
+                 'energy', 
+                 'key', 
+                 'loudness', 
+                 'mode', 
+                 'speechiness', 
+                 'acousticness', 
+                 'instrumentalness', 
+                 'liveness', 
+                 'valence', 
+                 'tempo', 
+                 'duration_ms', 
+                 'time_signature']
+
+# One record per track, with its metadata and audio features side by side; used from sync through scoring.
+# `features` holds DATA_FEATURES in order, so records['features'] is already the model's input matrix.
+# The name and the list of (artist id, artist name) pairs stay Python objects (only sync writes them), everything else is fixed width.
+TRACK_DTYPE = np.dtype([
+    ('id', 'S22'),
+    ('name', object),
+    ('artists', object),
+    ('liked', np.int8),
+    ('features', np.float64, (len(DATA_FEATURES),)),
+])
+TRACK_COLUMNS = ['id', 'name', 'liked'] + DATA_FEATURES
+
+def track_records(tracks, features, liked=-1):
+    # Tracks without audio features are dropped; candidates (not yet rated) have liked = -1
+    rows = []
+    for track, f in zip(tracks, features):
+        if not f:
+            continue
+        artists = [(artist['id'], artist['name']) for artist in track['artists'] if artist['id']]
+        rows.append((track['id'], track['name'], artists, liked, [track['popularity']] + [f[column] for column in DATA_FEATURES[1:]]))
+
+    records = np.empty(len(rows), dtype=TRACK_DTYPE)
+    records[:] = rows
+    return records
+
+def track_rows(records):
+    # SQLite rows (in TRACK_COLUMNS order) for a record array
+    ids = np.char.decode(records['id']).tolist()
+    return [(track_id, name, liked, *features)
+            for track_id, name, liked, features in zip(ids, records['name'], records['liked'].tolist(), records['features'].tolist())]
+
+def artist_rows(records):
+    # (artists, track_artists) rows for a record array
+    ids = np.char.decode(records['id']).tolist()
+    artists = {artist_id: name for track_artists in records['artists'] for artist_id, name in track_artists}
+    track_artists = [(track_id, artist_id, position)
+                     for track_id, artist_ids in zip(ids, records['artists'])
+                     for position, (artist_id, name) in enumerate(artist_ids)]
+    return list(artists.items()), track_artists
+
+def feature_matrix(records, columns=DATA_FEATURES):
+    # The contiguous float32 model input for `columns`
+    x = records['features']
+    if columns != DATA_FEATURES:
+        x = x[:, [DATA_FEATURES.index(column) for column in columns]]
+    return np.ascontiguousarray(x, dtype=np.float32)
+
+MATRIX_DIR = 'matrix'
+MATRIX_COLUMNS = ['liked'] + DATA_FEATURES
+
+@db_connection
+def db_load_matrix(db=None):
+    # The training set lives in append-only float32/S22 files under MATRIX_DIR, read back as memory maps.
+    # Only rows added to `tracks` since the last load (by rowid) are read from SQLite and appended.
+    directory = DBConnection().data_path(MATRIX_DIR)
+    os.makedirs(directory, exist_ok=True)
+    features_path = os.path.join(directory, 'features.f32')
+    ids_path = os.path.join(directory, 'ids.s22')
+    meta_path = os.path.join(directory, 'meta.json')
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+
+    # A schema migration may renumber rowids, so the cache is only trusted for the schema it was written under
+    row_count = db.execute('SELECT count(*) FROM tracks').fetchone()[0]
+    valid = (meta.get('columns') == MATRIX_COLUMNS and meta.get('schema') == SCHEMA_VERSION and meta['rows'] <= row_count
+             and os.path.exists(features_path) and os.path.getsize(features_path) == meta['rows'] * len(MATRIX_COLUMNS) * 4
+             and os.path.exists(ids_path) and os.path.getsize(ids_path) == meta['rows'] * 22)
+    if not valid:
+        meta = {'columns': MATRIX_COLUMNS, 'schema': SCHEMA_VERSION, 'rows': 0, 'last_rowid': 0}
+        open(features_path, 'wb').close()
+        open(ids_path, 'wb').close()
+
+    cursor = db.execute(f'SELECT rowid, id, {", ".join(MATRIX_COLUMNS)} FROM tracks WHERE rowid > ? ORDER BY rowid', (meta['last_rowid'],))
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+
+        with open(features_path, 'ab') as f:
+            f.write(np.array([row[2:] for row in rows], dtype=np.float32).tobytes())
+        with open(ids_path, 'ab') as f:
+            f.write(np.array([row[1] for row in rows], dtype='S22').tobytes())
+
+        meta['rows'] += len(rows)
+        meta['last_rowid'] = rows[-1][0]
+
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+    if not meta['rows']:
+        return np.empty(0, dtype='S22'), np.empty((0, len(DATA_FEATURES)), dtype=np.float32), np.empty(0, dtype=np.float32)
+
+    matrix = np.memmap(features_path, dtype=np.float32, mode='r', shape=(meta['rows'], len(MATRIX_COLUMNS)))
+    ids = np.memmap(ids_path, dtype='S22', mode='r', shape=(meta['rows'],))
+
+    return ids, matrix[:, 1:], matrix[:, 0]
+
+@db_connection
+def db_select_seed_artists(db=None, n=10, track_ids=None):
+    try:
+        # Both are primary key / index lookups on track_artists (and on tracks.liked)
+        if track_ids:
+            statement = f""" SELECT artist_id
+                            FROM track_artists
+                            WHERE track_id IN ({", ".join("?" * len(track_ids))})
+                        """
+            params = list(track_ids)
+        else:
+            statement = """ SELECT artist_id
+                            FROM track_artists
+                            WHERE track_id IN (SELECT id FROM tracks WHERE liked = 1 ORDER BY random() LIMIT ?)
+                        """
+            params = (n,)
+
         cursor = db.cursor()
-        cursor.execute(statement, (liked,))
+        cursor.execute(statement, params)
         rows = cursor.fetchall()
 
-        return rows
+        return list(dict.fromkeys(row[0] for row in rows))
 
     except Error as e:
         print('Error: ' + str(e), color='red')
 
 @db_connection
-def db_get_all(db=None):
+def db_select_features(db=None, track_ids=None):
+    features = {}
+    cursor = db.cursor()
+
+    for batch in batched(track_ids, 500):
+        statement = f'SELECT id, {", ".join(FEATURE_COLUMNS)} FROM audio_features WHERE id IN ({", ".join("?" * len(batch))})'
+        for row in cursor.execute(statement, batch):
+            features[row[0]] = dict(zip(FEATURE_COLUMNS, row[1:]))
+
+    return features
+
+@db_connection
+def db_insert_features(db=None, features=None):
     try:
-        statement = """ SELECT *
-                        FROM tracks
+        statement = f""" INSERT OR REPLACE INTO audio_features (id, {', '.join(FEATURE_COLUMNS)})
+                        VALUES(?, {', '.join('?' * len(FEATURE_COLUMNS))});
                     """
+        with db:
+            db.executemany(statement, [(f['id'], *(f[column] for column in FEATURE_COLUMNS)) for f in features])
+    except Error as e:
+        print('Error: ' + str(e), color='red')
 
-        cursor = db.cursor()
-        cursor.execute(statement)
-        rows = cursor.fetchall()
+GRAPH_TTL = 30*24*60*60
 
-        return rows
+@db_connection
+def db_select_related(db=None, artist_ids=None, max_age=GRAPH_TTL):
+    # Related artists (in Spotify's order) for every artist whose edges were fetched within max_age
+    related = {}
+    cursor = db.cursor()
 
+    for batch in batched(artist_ids, 500):
+        statement = f""" SELECT f.artist_id, g.related_id
+                        FROM artist_fetched f LEFT JOIN artist_graph g ON g.artist_id = f.artist_id
+                        WHERE f.artist_id IN ({", ".join("?" * len(batch))}) AND f.fetched_at > ?
+                        ORDER BY f.artist_id, g.rank
+                    """
+        for artist_id, related_id in cursor.execute(statement, (*batch, time.time() - max_age)):
+            related.setdefault(artist_id, [])
+            if related_id:
+                related[artist_id].append(related_id)
+
+    return related
+
+@db_connection
+def db_insert_related(db=None, related=None):
+    try:
+        with DBConnection().transaction():
+            db.executemany('DELETE FROM artist_graph WHERE artist_id = ?', [(artist_id,) for artist_id in related])
+            db.executemany('INSERT OR IGNORE INTO artist_graph (artist_id, related_id, rank) VALUES(?, ?, ?)',
+                           [(artist_id, related_id, rank) for artist_id, ids in related.items() for rank, related_id in enumerate(ids)])
+            db.executemany('INSERT OR REPLACE INTO artist_fetched (artist_id, fetched_at) VALUES(?, ?)',
+                           [(artist_id, time.time()) for artist_id in related])
     except Error as e:
         print('Error: ' + str(e), color='red')
 
@@ -144,6 +537,14 @@ class SPConnection:
     client_secret = ''
     redirect_uri = 'http://google.com/'
     sp = None
+    cache = None
+    cache_path = None
+
+    # One client, token refresher and profile per user, all sharing one pooled keep-alive session
+    session = None
+    clients = {}
+    refreshers = {}
+    profiles = {}
 
     def __init__(self):
         self.username = SPConnection.username
@@ -152,23 +553,209 @@ class SPConnection:
         self.client_secret = SPConnection.client_secret
         self.redirect_uri = SPConnection.redirect_uri
 
-    def set_all(self, username, client_id, client_secret):
+    def set_all(self, username, client_id, client_secret, redirect_uri=None):
         SPConnection.username = username
         SPConnection.scope = 'user-library-read user-library-modify playlist-modify-public playlist-modify-private user-read-private user-read-playback-state user-modify-playback-state'
         SPConnection.client_id = client_id
         SPConnection.client_secret = client_secret
-        SPConnection.redirect_uri = 'http://google.com/'
+        SPConnection.redirect_uri = redirect_uri or 'http://google.com/'
+
+    def get_session(self):
+        if not SPConnection.session:
+            import requests
+
+            # A plain adapter has no urllib3 retries, so 429s and 5xxs reach SPClient with their headers intact;
+            # SPClient.call retries those and connection errors itself
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2, max_retries=0)
+            SPConnection.session = requests.Session()
+            SPConnection.session.mount('https://', adapter)
+            SPConnection.session.mount('http://', adapter)
+        return SPConnection.session
 
     def reset_connection(self):
-        token = spotipy.util.prompt_for_user_token(SPConnection.username, SPConnection.scope, SPConnection.client_id, SPConnection.client_secret, SPConnection.redirect_uri)
-        sp = spotipy.Spotify(auth=token)
+        import spotipy
+
+        oauth = spotipy.SpotifyOAuth(self.client_id, self.client_secret, self.redirect_uri, scope=self.scope,
+                                     username=self.username, requests_session=self.get_session())
+
+        token_info = oauth.validate_token(oauth.cache_handler.get_cached_token())
+        if not token_info:
+            oauth.get_access_token(oauth.get_auth_response(), as_dict=False)
+            token_info = oauth.cache_handler.get_cached_token()
+
+        sp = spotipy.Spotify(auth=token_info['access_token'], requests_session=self.get_session())
+
+        refresher = SPConnection.refreshers.pop(self.username, None)
+        if refresher:
+            refresher.stop()
+        SPConnection.refreshers[self.username] = TokenRefresher(oauth, sp, token_info)
+        SPConnection.clients[self.username] = sp
+
         return sp
 
     def get_connection(self):
         if SPConnection.sp:
-            return SPConnection.sp
+            sp = SPConnection.sp
         else:
-            return SPConnection().reset_connection()
+            sp = SPConnection.clients.get(self.username) or self.reset_connection()
+        return CachedSpotify(SPClient(sp), self.get_cache())
+
+    def user_id(self):
+        if self.username not in SPConnection.profiles:
+            SPConnection.profiles[self.username] = self.get_connection().current_user()
+        return SPConnection.profiles[self.username]['id']
+
+    def close_connection(self):
+        for refresher in SPConnection.refreshers.values():
+            refresher.stop()
+        SPConnection.refreshers.clear()
+        SPConnection.clients.clear()
+        SPConnection.profiles.clear()
+
+        if SPConnection.session:
+            SPConnection.session.close()
+            SPConnection.session = None
+
+    def get_cache(self):
+        if not SPConnection.cache:
+            path = SPConnection.cache_path or DBConnection().data_path('cache.db')
+            SPConnection.cache = TTLCache(path, ttl=CACHE_TTL)
+        return SPConnection.cache
+
+    def close_cache(self):
+        if SPConnection.cache:
+            SPConnection.cache.close()
+            SPConnection.cache = None
+
+atexit.register(SPConnection().close_connection)
+
+class TokenRefresher(threading.Thread):
+    """
+    Refreshes a client's OAuth token in the background shortly before it expires,
+    so no request ever waits on (or fails with) an expired token.
+    """
+
+    margin = 5*60
+
+    def __init__(self, oauth, sp, token_info):
+        super().__init__(daemon=True)
+        self.oauth = oauth
+        self.sp = sp
+        self.token_info = token_info
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        while True:
+            delay = max(0, self.token_info['expires_at'] - self.margin - time.time())
+            if self.stopped.wait(delay):
+                return
+
+            try:
+                self.token_info = self.oauth.refresh_access_token(self.token_info['refresh_token'])
+                self.sp.set_auth(self.token_info['access_token'])
+            except Exception as e:
+                print('Error refreshing Spotify token: ' + str(e), color='red')
+                if self.stopped.wait(30):
+                    return
+
+    def stop(self):
+        self.stopped.set()
+
+# Seconds that slowly-changing catalog responses are served from cache.db before being fetched again
+# (related artists are kept in the artist graph instead, see GRAPH_TTL)
+CACHE_TTL = {
+    'artist_top_tracks': 24*60*60,
+}
+
+class CachedSpotify:
+    def __init__(self, sp, cache):
+        self.sp = sp
+        self.cache = cache
+
+    def __getattr__(self, name):
+        attr = getattr(self.sp, name)
+        if name not in CACHE_TTL:
+            return attr
+
+        @wraps(attr)
+        def cached(*args, **kwargs):
+            key = json.dumps([args, kwargs], sort_keys=True)
+            return self.cache.get(name, key, lambda: attr(*args, **kwargs))
+
+        return cached
+
+class SPClient:
+    bucket = TokenBucket(rate=20, capacity=40)
+    limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=16)
+    global_limit = None
+    max_retries = 5
+    max_backoff = 60
+    stats = {'calls': 0, 'throttles': 0, 'retries': 0, 'errors': 0}
+    stats_lock = threading.Lock()
+
+    def __init__(self, sp):
+        self.sp = sp
+
+    def __getattr__(self, name):
+        attr = getattr(self.sp, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            return self.call(attr, *args, **kwargs)
+
+        return call
+
+    def call(self, f, *args, **kwargs):
+        from spotipy.client import SpotifyException
+        from requests.exceptions import ConnectionError, Timeout
+
+        for attempt in range(SPClient.max_retries + 1):
+            SPClient.bucket.acquire()
+
+            # global_limit is a semaphore shared by every worker process when the scheduler serves many users
+            with SPClient.limiter, SPClient.global_limit or nullcontext():
+                started = time.monotonic()
+                try:
+                    result = f(*args, **kwargs)
+                except (SpotifyException, ConnectionError, Timeout) as e:
+                    if getattr(e, 'http_status', None) == 429:
+                        # Retry-After applies to the whole app, so every worker waits it out through the bucket
+                        SPClient.count('throttles')
+                        SPClient.limiter.throttled(started)
+                        SPClient.bucket.pause(retry_after(e, default=2 ** attempt))
+                        delay = 0
+                    elif not isinstance(e, SpotifyException) or e.http_status >= 500:
+                        # 5xxs and dropped or timed out connections (the session itself doesn't retry)
+                        delay = random.uniform(0, min(SPClient.max_backoff, 2 ** attempt))
+                    else:
+                        raise
+
+                    if attempt == SPClient.max_retries:
+                        SPClient.count('errors')
+                        raise
+                else:
+                    SPClient.count('calls')
+                    SPClient.limiter.succeeded()
+                    return result
+
+            SPClient.count('retries')
+            time.sleep(delay)
+
+    @staticmethod
+    def count(name):
+        with SPClient.stats_lock:
+            SPClient.stats[name] += 1
+
+def retry_after(e, default=1):
+    try:
+        return float(e.headers['Retry-After'])
+    except (TypeError, KeyError, ValueError):
+        return default
+
+MAX_WORKERS = 8
 
 def sp_connection(f):
     @wraps(f)
@@ -178,255 +765,929 @@ def sp_connection(f):
 
     return wrapper
 
+def get_audio_features(sp, track_ids, executor=None):
+    # Audio features never change: serve what the store has and batch-fetch only the rest
+    features = db_select_features(track_ids=track_ids)
+    missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in features]
+
+    if missing:
+        batches = batched(missing, 100)
+        results = executor.map(sp.audio_features, batches) if executor else map(sp.audio_features, batches)
+        fetched = [f for batch_features in results for f in batch_features if f]
+
+        db_insert_features(features=fetched)
+        features.update((f['id'], f) for f in fetched)
+
+    return [features.get(track_id) for track_id in track_ids]
+
+def sync_batch(sp, items, liked):
+    # One feature lookup and one transaction per page instead of one of each per track
+    tracks = [item['track'] for item in items if item['track'] and item['track']['id']]
+    missing = set(TrackIndex().missing([track['id'] for track in tracks]))
+    tracks = [track for track in tracks if track['id'] in missing]
+
+    if not tracks:
+        return 0
+
+    features = get_audio_features(sp, [track['id'] for track in tracks])
+
+    return db_insert_tracks(tracks=track_records(tracks, features, liked)) or 0
+
+def fetch_pages(executor, fetch, offsets, window):
+    # Yields (offset, page) as each page arrives, with at most `window` requests queued on the executor
+    offsets = iter(offsets)
+    futures = {}
+
+    def submit():
+        offset = next(offsets, None)
+        if offset is not None:
+            futures[executor.submit(fetch, offset)] = offset
+
+    for _ in range(window):
+        submit()
+
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            offset = futures.pop(future)
+            submit()
+            yield offset, future.result()
+
+def bulk_import(sp, source, fetch, page_size, liked, version='', workers=MAX_WORKERS):
+    # The first page gives the total, after which every page offset is known up front: the rest are fetched
+    # `workers` at a time and each is written (features and tracks) as soon as it arrives.
+    # Finished pages are checkpointed, so an interrupted import picks up where it stopped,
+    # unless the source has changed since (a different total, first track or version starts it over).
+    first = fetch(0)
+    first_id = first['items'][0]['track']['id'] if first['items'] and first['items'][0]['track'] else ''
+    generation = f"{version}:{first['total']}:{first_id}"
+    done = db_start_import(source=source, generation=generation)
+    inserted = 0
+
+    if 0 not in done:
+        inserted += sync_batch(sp, first['items'], liked)
+        db_mark_imported(source=source, generation=generation, offset=0)
+
+    offsets = [offset for offset in range(page_size, first['total'], page_size) if offset not in done]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for offset, page in fetch_pages(executor, fetch, offsets, window=workers * 2):
+            inserted += sync_batch(sp, page['items'], liked)
+            db_mark_imported(source=source, generation=generation, offset=offset)
+
+    db_finish_import(source=source)
+    return inserted, first
+
 @sp_connection
 def load_playlist_tracks(sp=None, playlist_id=None, liked=0):
-    user = sp.current_user()['id']
-    index = 0
-    playlist_length = sp.user_playlist_tracks(user=user, playlist_id=playlist_id, limit=1)['total']
-    
-    while index < playlist_length:
-        batch = sp.user_playlist_tracks(user=user, playlist_id=playlist_id, offset=index)
-        
-        for track in batch['items']:
-            if not db_has_track(track_id=track['track']['id']):
-
-                features = sp.audio_features(track['track']['id'])[0]
-
-                track_data = (track['track']['id'], track['track']['name'], [artist['name'] for artist in track['track']['artists']][0], [artist['id'] for artist in track['track']['artists']][0], 
-                            [artist['name'] for artist in track['track']['artists']][1] if len([artist['name'] for artist in track['track']['artists']]) > 1 else None,
-                            [artist['id'] for artist in track['track']['artists']][1] if len([artist['id'] for artist in track['track']['artists']]) > 1 else None,
-                            track['track']['popularity'], liked,
-                            features['acousticness'], 
-                            features['danceability'], features['duration_ms'],
-                            features['energy'], features['instrumentalness'], features['key'],
-                            features['liveness'], features['loudness'], features['mode'],
-                            features['speechiness'], features['valence'], features['tempo'], features['time_signature'],
-                            )
-
-                db_insert_track(track=track_data)
-
-        index += 100
+    # A playlist's snapshot_id changes whenever its contents do, so an unchanged one can be skipped outright
+    source = f'playlist:{playlist_id}'
+    snapshot_id = sp.playlist(playlist_id, fields='snapshot_id')['snapshot_id']
+    if snapshot_id == db_get_sync_state(source=source):
+        return 0
+
+    fields = 'items(track(id,name,popularity,artists(id,name))),total'
+    fetch = lambda offset: sp.playlist_items(playlist_id, fields=fields, limit=100, offset=offset)
+    inserted, first = bulk_import(sp, source, fetch, 100, liked, version=snapshot_id)
+
+    db_set_sync_state(source=source, value=snapshot_id)
+    return inserted
 
 @sp_connection
 def load_saved_tracks(sp=None):
+    # Saved tracks come newest first, so paging can stop at the first track older than the last sync
+    source = 'saved_tracks'
+    last_added = db_get_sync_state(source=source)
+
+    if not last_added:
+        # First sync (or one that was interrupted): import the whole library in parallel
+        fetch = lambda offset: sp.current_user_saved_tracks(limit=50, offset=offset)
+        inserted, first = bulk_import(sp, source, fetch, 50, 1)
+        if first['items']:
+            db_set_sync_state(source=source, value=first['items'][0]['added_at'])
+        return inserted
+
+    newest = None
     index = 0
-    saved_length = sp.current_user_saved_tracks(limit=1)['total']
+    inserted = 0
+
+    while True:
+        batch = sp.current_user_saved_tracks(limit=50, offset=index)
+        items = batch['items']
+
+        if items and not newest:
+            newest = items[0]['added_at']
+
+        items = [item for item in items if item['added_at'] >= last_added]
+        inserted += sync_batch(sp, items, 1)
+
+        if len(items) < len(batch['items']) or not batch['next']:
+            break
+        index += 50
+
+    if newest:
+        db_set_sync_state(source=source, value=newest)
+    return inserted
+
+def batched(items, size):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def related_artists(sp, artist_ids, executor=None):
+    # Serve edges from the local artist graph and fetch (then store) only unknown or stale artists
+    related = db_select_related(artist_ids=artist_ids)
+    missing = [artist_id for artist_id in artist_ids if artist_id not in related]
+
+    if missing:
+        results = executor.map(sp.artist_related_artists, missing) if executor else map(sp.artist_related_artists, missing)
+        fetched = {artist_id: [artist['id'] for artist in result['artists']] for artist_id, result in zip(missing, results)}
+
+        db_insert_related(related=fetched)
+        related.update(fetched)
 
-    while index < saved_length:
-        batch = sp.current_user_saved_tracks(offset=index)
-        
-        for track in batch['items']:
-            if not db_has_track(track_id=track['track']['id']):
+    return related
 
-                features = sp.audio_features(track['track']['id'])[0]
+WALK_DEPTH = 2
+WALK_FANOUT = 5
+WALK_ARTISTS = 40
 
-                track_data = (track['track']['id'], track['track']['name'], [artist['name'] for artist in track['track']['artists']][0], [artist['id'] for artist in track['track']['artists']][0], 
-                              [artist['name'] for artist in track['track']['artists']][1] if len([artist['name'] for artist in track['track']['artists']]) > 1 else None,
-                              [artist['id'] for artist in track['track']['artists']][1] if len([artist['id'] for artist in track['track']['artists']]) > 1 else None,
-                              track['track']['popularity'], 1,
-                              features['acousticness'], 
-                              features['danceability'], features['duration_ms'],
-                              features['energy'], features['instrumentalness'], features['key'],
-                              features['liveness'], features['loudness'], features['mode'],
-                              features['speechiness'], features['valence'], features['tempo'], features['time_signature'],
-                              )
+def walk_artists(sp, seeds, executor=None, depth=WALK_DEPTH, fanout=WALK_FANOUT, max_artists=WALK_ARTISTS, rng=None):
+    # Weighted BFS over the artist graph: each hop samples up to `fanout` artists per frontier artist,
+    # weighted by the parent's weight over Spotify's rank, so closer and stronger relations are favoured
+    rng = rng or np.random.default_rng()
 
-                db_insert_track(track=track_data)
+    visited = set(seeds)
+    frontier = {artist_id: 1.0 for artist_id in visited}
+    weights = {}
 
+    for hop in range(depth):
+        # What is left of max_artists is split over the remaining hops, so the deeper ones get their share,
+        # and a hop with nothing left to pick doesn't fetch its frontier's related artists at all
+        budget = math.ceil((max_artists - len(weights)) / (depth - hop))
+        if budget <= 0 or not frontier:
+            break
 
-        index += 20
+        related = related_artists(sp, list(frontier), executor=executor)
+
+        candidates = {}
+        for artist_id, weight in frontier.items():
+            for rank, related_id in enumerate(related.get(artist_id, [])[:fanout * 2]):
+                if related_id not in visited:
+                    candidates[related_id] = candidates.get(related_id, 0) + weight / (rank + 1)
+
+        budget = min(len(candidates), len(frontier) * fanout, budget)
+        if budget <= 0:
+            break
+
+        ids = list(candidates)
+        p = np.array([candidates[artist_id] for artist_id in ids])
+        chosen = rng.choice(len(ids), size=budget, replace=False, p=p / p.sum())
+
+        frontier = {ids[i]: candidates[ids[i]] for i in chosen}
+        weights.update(frontier)
+        visited.update(frontier)
+
+    return weights
+
+MICRO_BATCH = 50
 
 @sp_connection
-def get_recommendations(sp=None, data=None):
-
-    liked = data[data['liked'] == 1]['id'].values.tolist()
-    disliked = data[data['liked'] == 0]['id'].values.tolist()
-
-    samples = data[data['liked'] == 1].sample(n=10)
-    samples = [row for index, row in samples.iterrows()]
-    
-    all_tracks = []
-    all_ids = set()
-
-    for sample in samples:
-        for artist_id in [sample['artist1ID'], sample['artist2ID']]:
-            if artist_id:
-
-                related_artists = sp.artist_related_artists(artist_id)['artists'][:5]
-                related_artists = [artist['id'] for artist in related_artists]
-
-                for related_id in related_artists:
-                    top_tracks = sp.artist_top_tracks(related_id)['tracks'][:5]
-
-                    for track in top_tracks:
-                        if track['id'] not in liked and track['id'] not in disliked and track['id'] not in all_ids:
-
-                            features = sp.audio_features(track['id'])[0]
-
-                            t = {
-                                # MetaData
-                                'id': track['id'],
-                                'name': track['name'],
-                                'artist1': [artist['name'] for artist in track['artists']][0],
-                                'artist1ID': [artist['id'] for artist in track['artists']][0],
-                                'artist2': [artist['name'] for artist in track['artists']][1] if len([artist['name'] for artist in track['artists']]) > 1 else None,
-                                'artist2ID': [artist['id'] for artist in track['artists']][1] if len([artist['id'] for artist in track['artists']]) > 1 else None,
-                                'popularity': track['popularity'],
-                                'liked': None,
-
-                                # Audio Features
-                                'danceability': features['danceability'],
-                                'energy': features['energy'],
-                                'key': features['key'],
-                                'loudness': features['loudness'],
-                                'mode': features['mode'],
-                                'speechiness': features['speechiness'],
-                                'acousticness': features['acousticness'],
-                                'instrumentalness': features['instrumentalness'],
-                                'liveness': features['liveness'],
-                                'valence': features['valence'],
-                                'tempo': features['tempo'],
-                                'duration_ms': features['duration_ms'],
-                                'time_signature': features['time_signature']
-                            }
-
-                            all_ids.add(track['id'])
-                            all_tracks.append(t)
-            
-    return all_tracks
+def get_recommendations(sp=None, seeds=None, workers=MAX_WORKERS, batch_size=MICRO_BATCH, max_artists=WALK_ARTISTS):
+    # Yields candidates (with audio features) in micro-batches, strongest related artists first.
+    # Nothing is fetched ahead of the consumer, so closing the generator stops all further API calls.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Seeds often share artists, so each artist (and each related artist) is looked up once
+        related = walk_artists(sp, set(seeds or ()), executor=executor, max_artists=max_artists)
+        artists = sorted(related, key=related.get, reverse=True)
+
+        seen = set()
+        pending = []
+        for artist_batch in batched(artists, workers):
+            tracks = [track for top in executor.map(lambda related_id: sp.artist_top_tracks(related_id)['tracks'][:5], artist_batch) for track in top]
+            missing = set(TrackIndex().missing([track['id'] for track in tracks]))
+            for track in tracks:
+                if track['id'] in missing and track['id'] not in seen:
+                    seen.add(track['id'])
+                    pending.append(track)
+
+            while len(pending) >= batch_size:
+                yield candidate_batch(sp, pending[:batch_size], executor)
+                pending = pending[batch_size:]
+
+        if pending:
+            yield candidate_batch(sp, pending, executor)
+
+def candidate_batch(sp, tracks, executor=None):
+    features = get_audio_features(sp, [track['id'] for track in tracks], executor=executor)
+    return track_records(tracks, features)
 
 @sp_connection
 def create_playlist(sp=None, title='', description=''):
-    user = sp.current_user()['id']
+    user = SPConnection().user_id()
     playlist_id = sp.user_playlist_create(user=user, name=title, description=description)['id']
     return playlist_id
 
+PLAYLIST_CHUNK = 100
+
 @sp_connection
 def playlist_add_tracks(sp=None, playlist_id=None, tracks=None):
-    user = sp.current_user()['id']
-    sp.user_playlist_add_tracks(user=user, playlist_id=playlist_id, tracks=tracks)
+    # Spotify takes at most 100 tracks per request. Appends stay sequential, since concurrent
+    # appends (or inserts at a position) could land out of order
+    for chunk in batched(tracks, PLAYLIST_CHUNK):
+        sp.playlist_add_items(playlist_id, chunk)
+
+REPLACE_PLAYLIST = True
+PUBLISHED_PLAYLIST = 'publish:discover_daily'
+
+def playlist_followed(sp, playlist_id):
+    from spotipy.client import SpotifyException
+
+    try:
+        # Spotify.playlist_is_following raises on its own deprecation warning in recent spotipy, so the endpoint is called directly
+        return sp._get(f'playlists/{playlist_id}/followers/contains', ids=SPConnection().user_id())[0]
+    except SpotifyException as e:
+        if e.http_status != 404:
+            raise
+        return False
+
+@sp_connection
+def publish_playlist(sp=None, title='', description='', tracks=None, replace=REPLACE_PLAYLIST):
+    # Reuses the Discover Daily playlist from the last run (renamed, with its tracks replaced) rather than
+    # creating a new one each day: one replace request, one per further 100 tracks, and the rename alongside them
+    from spotipy.client import SpotifyException
+
+    chunks = list(batched(tracks, PLAYLIST_CHUNK))
+    playlist_id = db_get_sync_state(source=PUBLISHED_PLAYLIST) if replace else None
+
+    # Deleting a playlist in Spotify only unfollows it, and it still accepts edits: one the user
+    # no longer follows is left alone and a new one is created in its place
+    if playlist_id and not playlist_followed(sp, playlist_id):
+        playlist_id = None
+
+    if playlist_id:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            details = executor.submit(sp.playlist_change_details, playlist_id, name=title, description=description)
+            try:
+                sp.playlist_replace_items(playlist_id, chunks[0] if chunks else [])
+                details.result()
+            except SpotifyException as e:
+                if e.http_status != 404:
+                    raise
+                # Deleted (or unfollowed) since the last run
+                playlist_id = None
+
+    if not playlist_id:
+        playlist_id = create_playlist(title=title, description=description)
+        if chunks:
+            sp.playlist_add_items(playlist_id, chunks[0])
+        if replace:
+            db_set_sync_state(source=PUBLISHED_PLAYLIST, value=playlist_id)
+
+    # The first chunk went in with the replace (or create) above
+    playlist_add_tracks(playlist_id=playlist_id, tracks=list(tracks)[PLAYLIST_CHUNK:])
+
+    return playlist_id
 
 # ----------------------------------------------------------------
 
-def main(playlist_length, username, client_id, client_secret, redirect_uri, width=8):
+MODEL_DIR = 'models'
+MODEL_PARAMS = {'min_samples_split': 100}
+MODELS_KEPT = 5
+WARM_START_ESTIMATORS = 10
+MAX_INCREMENTS = 7
+TEST_SHARE = 0.15
+
+def data_fingerprint(ids, x, y, columns, estimator, params):
+    digest = hashlib.sha256()
+    for array in (ids, x, y):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps({'estimator': estimator.__name__, 'params': params, 'columns': columns}, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+def holdout(ids, share=TEST_SHARE):
+    # Test rows are picked by a hash of the track id, so a track stays on the same side of the split as the
+    # library grows, and an incrementally trained model is never scored on rows an earlier run trained on
+    return np.array([zlib.crc32(track_id) % 1000 < share * 1000 for track_id in ids], dtype=bool)
+
+def train_model(ids, x, y, columns=DATA_FEATURES, estimator=None, params=MODEL_PARAMS, incremental=False):
+    # Models are saved under a fingerprint of the training rows and hyperparameters,
+    # so an unchanged library reuses the last model instead of retraining
+    import joblib
+    from sklearn.metrics import accuracy_score
+    if estimator is None:
+        from sklearn.tree import DecisionTreeClassifier as estimator
+
+    model_dir = DBConnection().data_path(MODEL_DIR)
+    os.makedirs(model_dir, exist_ok=True)
+    fingerprint = data_fingerprint(ids, x, y, columns, estimator, params)
+    path = os.path.join(model_dir, f'{fingerprint}.joblib')
+
+    if os.path.exists(path):
+        saved = joblib.load(path)
+        save_latest(model_dir, path, estimator, params, columns)
+        return saved['model'], saved['accuracy'], False
+
+    test = holdout(ids)
+    train = ~test
+
+    model, increments = None, 0
+    if incremental:
+        model, increments = update_model(ids[train], x[train], y[train], columns, estimator, params)
+    if model is None:
+        model = estimator(**params).fit(x[train], y[train])
+
+    accuracy = accuracy_score(y[test], model.predict(x[test])) * 100
+
+    joblib.dump({'model': model, 'accuracy': accuracy, 'ids': np.array(ids[train]), 'increments': increments}, path)
+    save_latest(model_dir, path, estimator, params, columns)
+    prune_models(model_dir)
+
+    return model, accuracy, True
+
+def save_latest(model_dir, path, estimator, params, columns):
+    with open(os.path.join(model_dir, 'latest.json'), 'w') as f:
+        json.dump({'path': path, 'estimator': estimator.__name__, 'params': params, 'columns': columns}, f)
+
+def load_model():
+    # The model the last train run produced or reused, so recommend can run on its own
+    import joblib
 
-    p1 = ProgressBar('Gathering Your Liked and Disliked Songs', steps=5, width=width, completion='Songs Gathered')
+    try:
+        with open(DBConnection().data_path(MODEL_DIR, 'latest.json')) as f:
+            latest = json.load(f)
+        saved = joblib.load(latest['path'])
+    except (OSError, ValueError, KeyError):
+        return None, None, None
 
-    p1.update(step_name='Connecting to Spotify')
-    SPConnection().set_all(username, client_id, client_secret)
-    # SPConnection().get_connection()
+    return saved['model'], saved['accuracy'], latest['columns']
 
-    p1.update(step_name='Connecting to the Database')
-    connection = db_create_connection('records.db')
-    db_create_table()
+def update_model(ids, x, y, columns, estimator, params):
+    # Incremental mode (train --incremental): continue from the latest model when the estimator supports it.
+    # Returns (model, increments since the last full fit), or (None, 0) when a full fit is due: the estimator
+    # can't continue, the latest model was trained differently, or it has already grown MAX_INCREMENTS times
+    import joblib
 
-    p1.update(step_name='Collecting Your Saved Tracks')
-    load_saved_tracks()
+    try:
+        with open(DBConnection().data_path(MODEL_DIR, 'latest.json')) as f:
+            latest = json.load(f)
+        previous = joblib.load(latest['path'])
+    except (OSError, ValueError, KeyError):
+        return None, 0
+
+    if (latest['estimator'], latest['params'], latest['columns']) != (estimator.__name__, params, columns):
+        return None, 0
+
+    increments = previous.get('increments', 0) + 1
+    if increments > MAX_INCREMENTS:
+        return None, 0
+
+    model = previous['model']
+    if hasattr(model, 'partial_fit'):
+        new = ~np.isin(ids, previous['ids'])
+        if new.any():
+            model.partial_fit(x[new], y[new])
+        return model, increments
+
+    # Ensembles grow from where they stopped: forests by n_estimators, hist_gb by boosting iterations (max_iter)
+    params = model.get_params()
+    size = next((name for name in ('n_estimators', 'max_iter') if name in params), None)
+    if 'warm_start' in params and size:
+        model.set_params(warm_start=True, **{size: params[size] + WARM_START_ESTIMATORS})
+        return model.fit(x, y), increments
+
+    return None, 0
+
+def prune_models(model_dir, prefix='', suffix='.joblib'):
+    paths = [os.path.join(model_dir, name) for name in os.listdir(model_dir) if name.startswith(prefix) and name.endswith(suffix)]
+    for path in sorted(paths, key=os.path.getmtime)[:-MODELS_KEPT]:
+        os.remove(path)
 
-    p1.update(step_name='Collecting Your Disliked Tracks')
-    load_playlist_tracks(playlist_id='6sd1N50ZULzrgoWX0ViDwC', liked=0)
+# ----------------------------------------------------------------
 
-    p1.update(step_name='Pulling Track Details from the Database')
-    all_tracks = db_get_all()
+MODEL = 'tree'
+SELECTION_FOLDS = 5
+SELECTION_JOBS = -1
+
+def knn_pipeline(**params):
+    # k-NN compares raw distances, so the features are scaled first (duration_ms would swamp the rest)
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.neighbors import KNeighborsClassifier
+
+    return make_pipeline(StandardScaler(), KNeighborsClassifier()).set_params(**params)
+
+def model_candidates():
+    # name: (estimator factory, parameter grid searched by `select`)
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.ensemble import HistGradientBoostingClassifier
+
+    return {
+        'tree': (DecisionTreeClassifier, {'min_samples_split': [25, 50, 100, 200], 'max_depth': [None, 8, 16]}),
+        'hist_gb': (HistGradientBoostingClassifier, {'learning_rate': [0.05, 0.1, 0.2], 'max_leaf_nodes': [15, 31]}),
+        'knn': (knn_pipeline, {'kneighborsclassifier__n_neighbors': [5, 15, 31], 'kneighborsclassifier__weights': ['uniform', 'distance']}),
+    }
+
+def select_model(ids, x, y, columns=DATA_FEATURES, folds=SELECTION_FOLDS, jobs=SELECTION_JOBS):
+    # Cross-validated grid search over every candidate, each search spread across `jobs` cores.
+    # Results are saved under the data fingerprint, so an unchanged library is never searched twice.
+    from sklearn.model_selection import GridSearchCV, StratifiedKFold
+
+    candidates = model_candidates()
+    grids = {name: grid for name, (estimator, grid) in candidates.items()}
+    model_dir = DBConnection().data_path(MODEL_DIR)
+    os.makedirs(model_dir, exist_ok=True)
+    fingerprint = data_fingerprint(ids, x, y, columns, select_model, {'grids': grids, 'folds': folds})
+    path = os.path.join(model_dir, f'selection-{fingerprint}.json')
 
-    data = pd.DataFrame(all_tracks, columns=['id','name','artist1','artist1ID','artist2','artist2ID','popularity','liked','danceability','duration_ms','energy','key','loudness','mode','speechiness','acousticness','instrumentalness','liveness','valence','tempo','time_signature'])
-    print(data.head())
+    try:
+        with open(path) as f:
+            results = json.load(f)['results']
+        cached = True
+    except (OSError, ValueError, KeyError):
+        cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=0)
+        fold_rows = len(ids) / folds
+
+        results = []
+        for name, (estimator, grid) in candidates.items():
+            search = GridSearchCV(estimator(), grid, cv=cv, scoring='accuracy', n_jobs=jobs, refit=False).fit(x, y)
+            best = search.best_index_
+            results.append({
+                'name': name,
+                'params': search.cv_results_['params'][best],
+                'accuracy': round(search.cv_results_['mean_test_score'][best] * 100, 2),
+                'accuracy_std': round(search.cv_results_['std_test_score'][best] * 100, 2),
+                'fit_seconds': round(search.cv_results_['mean_fit_time'][best], 4),
+                # score_time is predict + accuracy on one held-out fold
+                'predict_ms_per_1k': round(search.cv_results_['mean_score_time'][best] / fold_rows * 1e6, 3),
+            })
+        cached = False
+
+        with open(path, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'folds': folds, 'results': results}, f)
+        prune_models(model_dir, prefix='selection-', suffix='.json')
+
+    with open(os.path.join(model_dir, 'selection.json'), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'folds': folds, 'results': results}, f)
+
+    return results, cached
+
+def model_choice(name=None):
+    # The estimator to train for `name` (default MODEL), with the parameters the last select run found best for it
+    name = name or MODEL
+    estimator, grid = model_candidates()[name]
+    params = MODEL_PARAMS if name == 'tree' else {}
 
-    # ----------------------------------------------------------------  
+    try:
+        with open(DBConnection().data_path(MODEL_DIR, 'selection.json')) as f:
+            params = next(result['params'] for result in json.load(f)['results'] if result['name'] == name)
+    except (OSError, ValueError, KeyError, StopIteration):
+        pass
+
+    return estimator, params
+
+class TasteIndex:
+    """
+    KD-trees over the normalized audio features of liked tracks.
+
+    Usage: Build from the liked rows of the training matrix, then add newly liked rows as they arrive
+           New rows go into a second, small tree until they pass `rebuild_ratio` of the main one, then the main tree is rebuilt
+           Each row's density (used to pick seeds) is computed once, when the row is added
+    Args: x (feature rows), ids (their track ids), k (neighbours the density is measured over)
+    """
+
+    rebuild_ratio = 0.1
+
+    def __init__(self, x, ids, k=10):
+        self.k = k
+        self.build(np.asarray(x, dtype=np.float32), np.asarray(ids))
+        self.rows = 0
+
+    def build(self, x, ids):
+        self.mean = x.mean(axis=0) if len(x) else np.zeros(x.shape[1], dtype=np.float32)
+        self.scale = x.std(axis=0) if len(x) else np.ones(x.shape[1], dtype=np.float32)
+        self.scale[self.scale == 0] = 1
+
+        self.x = x
+        self.ids = ids
+        self.tree = self.make_tree(x)
+        self.pending_x = x[:0]
+        self.pending_ids = ids[:0]
+        self.pending_tree = None
+        self.density = self.row_density(x)
+        self.pending_density = self.density[:0]
+
+    def make_tree(self, x):
+        from sklearn.neighbors import KDTree
+        return KDTree(self.normalize(x)) if len(x) else None
+
+    def normalize(self, x):
+        return (np.asarray(x, dtype=np.float32) - self.mean) / self.scale
+
+    def add(self, x, ids):
+        x = np.asarray(x, dtype=np.float32)
+        self.pending_x = np.concatenate([self.pending_x, x])
+        self.pending_ids = np.concatenate([self.pending_ids, np.asarray(ids)])
+
+        if len(self.pending_x) > self.rebuild_ratio * max(len(self.x), 1):
+            self.build(np.concatenate([self.x, self.pending_x]), np.concatenate([self.ids, self.pending_ids]))
+        else:
+            self.pending_tree = self.make_tree(self.pending_x)
+            self.pending_density = np.concatenate([self.pending_density, self.row_density(x)])
+
+    def __len__(self):
+        return len(self.x) + len(self.pending_x)
+
+    def query(self, x, k=10):
+        # Distances to (and indexes of) the k nearest liked tracks for every row of x, from both trees
+        x = self.normalize(x)
+        k = min(k, len(self))
+
+        distances, indexes = np.empty((len(x), 0)), np.empty((len(x), 0), dtype=int)
+        if self.tree:
+            distances, indexes = self.tree.query(x, k=min(k, len(self.x)))
+        if self.pending_tree:
+            pending_distances, pending_indexes = self.pending_tree.query(x, k=min(k, len(self.pending_x)))
+            distances = np.concatenate([distances, pending_distances], axis=1)
+            indexes = np.concatenate([indexes, pending_indexes + len(self.x)], axis=1)
+
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indexes, order, axis=1)
+
+    def row_density(self, x):
+        # Inverse distance to the k-th neighbour (the row itself is its own nearest, hence k + 1)
+        if not len(x):
+            return np.empty(0)
+        distances, _ = self.query(x, k=self.k + 1)
+        return 1 / (distances[:, -1] + 1e-6)
+
+    def similarity(self, x, k=10):
+        if not len(self) or not len(x):
+            return np.zeros(len(x))
+        distances, _ = self.query(x, k=k)
+        return 1 / (1 + distances.mean(axis=1))
+
+    def dense_seeds(self, n=10, rng=None):
+        # Samples liked tracks weighted by local density
+        rng = rng or np.random.default_rng()
+        ids = np.concatenate([self.ids, self.pending_ids])
+        if len(ids) <= n:
+            return ids.tolist()
+
+        density = np.concatenate([self.density, self.pending_density])
+        chosen = rng.choice(len(ids), size=n, replace=False, p=density / density.sum())
+        return ids[chosen].tolist()
+
+def load_taste_index(ids, x, y):
+    # The index is saved next to the training matrix and only the rows appended since then are added
+    import joblib
+
+    path = DBConnection().data_path(MATRIX_DIR, 'taste.joblib')
+    try:
+        index = joblib.load(path)
+        if index.rows > len(ids) or (index.rows and ids[index.rows - 1] != index.last_id):
+            index = None
+        # Saved before densities were kept with the index
+        elif not hasattr(index, 'pending_density'):
+            index = None
+    except (OSError, ValueError, EOFError, AttributeError):
+        index = None
 
-    p2 = ProgressBar('Decision Tree Classifier', steps=3, width=width, completion='Classifier Trained')
+    # Nothing new since it was saved (e.g. recommend running right after train): use it as is
+    if index is not None and index.rows == len(ids):
+        return index
 
-    train, test = train_test_split(data, test_size=0.15)
+    liked = np.asarray(y) == 1
+    if index is None:
+        index = TasteIndex(x[liked], ids[liked])
+    else:
+        new = slice(index.rows, len(ids))
+        index.add(x[new][liked[new]], ids[new][liked[new]])
 
-    p2.update(step_name='Building Tree')
-    tree = DecisionTreeClassifier(min_samples_split=100)
+    index.rows = len(ids)
+    index.last_id = ids[-1] if len(ids) else None
+    joblib.dump(index, path)
 
-    data_features = ['popularity', 
-                    'danceability', 
-                    'energy', 
-                    'key', 
-                    'loudness', 
-                    'mode', 
-                    'speechiness', 
-                    'acousticness', 
-                    'instrumentalness', 
-                    'liveness', 
-                    'valence', 
-                    'tempo', 
-                    'duration_ms', 
-                    'time_signature']
+    return index
 
-    x_train = train[data_features]
-    y_train = train['liked']
+PRERANK_KEEP = 0.5
 
-    x_test = test[data_features]
-    y_test = test['liked']
+def prerank_candidates(index, candidates, keep):
+    # Keeps the `keep` candidates closest to the liked tracks
+    if len(candidates) <= keep or not len(index):
+        return candidates
 
-    p2.update(step_name=f'Training Tree with {len(train)} samples')
-    dt = tree.fit(x_train, y_train)
+    similarity = index.similarity(feature_matrix(candidates))
+    best = np.argpartition(-similarity, keep - 1)[:keep]
+    return candidates[np.sort(best)]
 
-    p2.update(step_name=f'Testing Tree with {len(test)} samples')
-    y_pred = tree.predict(x_test)
+EXPLORATION = 0.2
+THRESHOLD = 0.5
 
-    score = accuracy_score(y_test, y_pred) * 100
-    print(f'Decision Tree Accuracy: {round(score, 2)}')
+def predict_liked(model, candidates, columns=DATA_FEATURES):
+    if not len(candidates) or 1 not in model.classes_:
+        return np.zeros(len(candidates))
 
-    # ----------------------------------------------------------------
+    return model.predict_proba(feature_matrix(candidates, columns))[:, list(model.classes_).index(1)]
 
-    p3 = ProgressBar('Generating Recommendations', steps=4, width=width, completion='Daily Playlist Created')
-    
-    p3.update(step_name='Gathering a Variety of Songs')
-    new_tracks = get_recommendations(data=data)
+def score_candidates(model, candidates, k, columns=DATA_FEATURES, exploration=EXPLORATION, threshold=THRESHOLD, rng=None):
+    # Scores every candidate (as one contiguous float32 matrix) in one predict_proba call and returns the k best ids (with their scores),
+    # holding back an `exploration` share of the slots for random picks among the other likely hits
+    rng = rng or np.random.default_rng()
 
-    # ----------------------------------------------------------------
+    ids = candidates['id']
+    if not len(ids) or 1 not in model.classes_:
+        return [], []
 
-    date = datetime.strftime(datetime.now(), '%m/%d')
-    playlist_title = f'Discover Daily {date}'
-    p3.update(step_name=f'Creating Playlist {playlist_title}')
-    playlist_description = f"Generated {str(date)} by Noah Tigner's Recommender Engine"
+    scores = predict_liked(model, candidates, columns)
 
-    playlist_id = create_playlist(title=playlist_title, description=playlist_description)
+    positive = np.flatnonzero(scores >= threshold)
+    k = min(k, len(positive))
+    n_exploit = k - int(round(k * exploration))
 
-    # ----------------------------------------------------------------
+    top = positive[np.argpartition(-scores[positive], n_exploit - 1)[:n_exploit]] if n_exploit else positive[:0]
+    top = top[np.argsort(-scores[top], kind='stable')]
 
-    p3.update(step_name='Testing the Songs With the Classifier')
-    t = pd.DataFrame(new_tracks)
-    pred = t[data_features]
-    predictions = tree.predict(pred)
+    rest = np.setdiff1d(positive, top)
+    explore = rng.choice(rest, size=min(k - n_exploit, len(rest)), replace=False)
 
-    chosen = []
-    for i in range(len(predictions)):
-        if predictions[i] == 1:
-            chosen.append(t.iloc[i]['id'])
+    chosen = np.concatenate([top, explore])
+    return np.char.decode(ids[chosen]).tolist(), scores[chosen].tolist()
 
-    playlist_length = min([playlist_length, len(chosen) - 1, 100])
-    p3.update(step_name=f'Filling the Playlist with {playlist_length} songs you might like')
-    
-    choices = random.sample(chosen, k=playlist_length)
-    playlist_add_tracks(playlist_id=playlist_id, tracks=choices)
+# ----------------------------------------------------------------
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('playlist_length', help='Number of Tracks to Generate')
+HEADROOM = 0.5
 
+def stream_candidates(model, taste, batches, k, columns=DATA_FEATURES, threshold=THRESHOLD, headroom=HEADROOM, metrics=None):
+    # Scores each micro-batch as it arrives, and stops pulling (and so fetching) candidates once k * (1 + headroom)
+    # of them have passed the threshold. Every fetched candidate is scored, so none of the features fetched for it go
+    # to waste; the pre-rank only narrows the accepted pool (to the ones closest to your taste) before the best k are chosen
+    stage = metrics.stage if metrics else lambda name: nullcontext({'rows': 0})
+    target = math.ceil(k * (1 + headroom))
+    accepted = []
+
+    while sum(len(batch) for batch in accepted) < target:
+        with stage('candidates') as record:
+            batch = next(batches, None)
+            if batch is None:
+                break
+            record['rows'] += len(batch)
+
+        with stage('scoring') as record:
+            scores = predict_liked(model, batch, columns)
+            accepted.append(batch[scores >= threshold])
+            record['rows'] += len(batch)
+
+    batches.close()
+
+    with stage('scoring'):
+        accepted = np.concatenate(accepted) if accepted else np.empty(0, dtype=TRACK_DTYPE)
+        accepted = prerank_candidates(taste, accepted, keep=max(k, math.ceil(len(accepted) * PRERANK_KEEP)))
+        return score_candidates(model, accepted, k, columns=columns, threshold=threshold)
+
+def api_counters():
+    stats = dict(SPClient.stats)
+    return {'api_calls': stats['calls'], 'api_throttles': stats['throttles'], 'api_retries': stats['retries']}
+
+# ----------------------------------------------------------------
+# Each stage reads what the one before it persisted (records.db, the saved model, recommendations.json),
+# so any of them can be run, or retried, on its own
+
+RECOMMENDATIONS = 'recommendations.json'
+
+def open_database():
+    DBConnection().get_connection()
+    db_migrate()
+    TrackIndex().load()
+
+def save_recommendations(recommendations):
+    path = DBConnection().data_path(RECOMMENDATIONS)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(recommendations, f)
+    os.replace(path + '.tmp', path)
+
+def load_recommendations():
     try:
-        args = parser.parse_args()
-        playlist_length = int(args.playlist_length)
-        
-    except SystemExit as e:
-        print()
-        playlist_length = int(input('Enter The Number of Tracks to Generate: ', default=25, color='yellow'))
+        with open(DBConnection().data_path(RECOMMENDATIONS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def sync(metrics, playlist_length=None, width=8, headless=False, **options):
+    p1 = ProgressBar('Gathering Your Liked and Disliked Songs', steps=2, width=width, completion='Songs Gathered', animate=not headless, headless=headless)
+
+    with metrics.stage('sync') as stage:
+        p1.update(step_name='Collecting Your Saved Tracks')
+        stage['rows'] += load_saved_tracks()
+
+        p1.update(step_name='Collecting Your Disliked Tracks')
+        stage['rows'] += load_playlist_tracks(playlist_id='6sd1N50ZULzrgoWX0ViDwC', liked=0)
+
+def train(metrics, playlist_length=None, width=8, headless=False, model=MODEL, incremental=False, **options):
+    p2 = ProgressBar(f'Classifier ({model})', steps=3, width=width, completion='Classifier Trained', animate=not headless, headless=headless)
+
+    with metrics.stage('load') as stage:
+        p2.update(step_name='Pulling Track Details from the Database')
+        ids, x, y = db_load_matrix()
+        load_taste_index(ids, x, y)
+        stage['rows'] = len(ids)
+
+    if not len(ids):
+        print('Error: no tracks in records.db, run the sync stage first', color='red')
+        return
 
+    if not headless:
+        print(f'{len(ids)} tracks in your library, {int(y.sum())} liked and {len(ids) - int(y.sum())} disliked')
+
+    with metrics.stage('train') as stage:
+        p2.update(step_name=f'Training with {len(ids)} samples')
+        estimator, params = model_choice(model)
+        tree, score, trained = train_model(ids, x, y, DATA_FEATURES, estimator, params, incremental=incremental)
+        stage['rows'] = len(ids) if trained else 0
+
+        p2.update(step_name='Classifier Trained' if trained else 'Training Data Unchanged, Reusing Cached Classifier')
+
+    metrics.gauge('model_accuracy', round(score, 2))
+    if not headless:
+        print(f'Classifier Accuracy ({model}): {round(score, 2)}')
+
+def select(metrics, playlist_length=None, width=8, headless=False, **options):
+    p5 = ProgressBar('Model Selection', steps=2, width=width, completion='Models Compared', animate=not headless, headless=headless)
+
+    with metrics.stage('load') as stage:
+        p5.update(step_name='Pulling Track Details from the Database')
+        ids, x, y = db_load_matrix()
+        stage['rows'] = len(ids)
+
+    if not len(ids):
+        print('Error: no tracks in records.db, run the sync stage first', color='red')
+        return
+
+    with metrics.stage('select') as stage:
+        p5.update(step_name=f'Cross-Validating Every Candidate on {len(ids)} samples')
+        results, cached = select_model(ids, x, y, DATA_FEATURES)
+        stage['rows'] = 0 if cached else len(ids)
+
+    for result in results:
+        for key in ('accuracy', 'fit_seconds', 'predict_ms_per_1k'):
+            metrics.gauge(f"model_{result['name']}_{key}", result[key])
+
+    if not headless:
+        print(f"{'model':<10}{'accuracy':>10}{'+/-':>7}{'fit (s)':>10}{'predict (ms/1k)':>17}  parameters")
+        for result in results:
+            print(f"{result['name']:<10}{result['accuracy']:>10}{result['accuracy_std']:>7}{result['fit_seconds']:>10}{result['predict_ms_per_1k']:>17}  {result['params']}")
+        print('Train with one of them using --model NAME')
+
+def recommend(metrics, playlist_length=25, width=8, headless=False, **options):
+    p3 = ProgressBar('Generating Recommendations', steps=3, width=width, completion='Recommendations Saved', animate=not headless, headless=headless)
+
+    with metrics.stage('load') as stage:
+        p3.update(step_name='Loading the Classifier and Your Taste')
+        tree, score, data_features = load_model()
+        if tree is None:
+            print('Error: no trained model found, run the train stage first', color='red')
+            return
+
+        ids, x, y = db_load_matrix()
+        taste = load_taste_index(ids, x, y)
+        stage['rows'] = len(ids)
+
+    p3.update(step_name='Gathering a Variety of Songs')
+    with metrics.stage('candidates'):
+        seed_tracks = [track_id.decode() for track_id in taste.dense_seeds(n=10)]
+        # Each related artist offers at most 5 new tracks, so longer playlists walk further
+        batches = get_recommendations(seeds=db_select_seed_artists(track_ids=seed_tracks), max_artists=max(WALK_ARTISTS, playlist_length))
+
+    p3.update(step_name='Testing the Songs With the Classifier')
+    choices, scores = stream_candidates(tree, taste, batches, playlist_length, columns=data_features, metrics=metrics)
+
+    save_recommendations({'created': datetime.now().isoformat(), 'tracks': choices, 'scores': scores})
+
+def publish(metrics, playlist_length=None, width=8, headless=False, replace_playlist=REPLACE_PLAYLIST, **options):
+    p4 = ProgressBar('Publishing Your Playlist', steps=1, width=width, completion='Daily Playlist Created', animate=not headless, headless=headless)
+
+    recommendations = load_recommendations()
+    if not recommendations:
+        print('Error: no recommendations found, run the recommend stage first', color='red')
+        return
+    if recommendations.get('playlist_id'):
+        # Already published; a retry after a later failure shouldn't create the playlist twice
+        p4.update(step_name='Already Published')
+        return
+
+    with metrics.stage('publish') as stage:
+        date = datetime.strftime(datetime.fromisoformat(recommendations['created']), '%m/%d')
+        playlist_title = f'Discover Daily {date}'
+        playlist_description = f"Generated {str(date)} by Noah Tigner's Recommender Engine"
+
+        choices = recommendations['tracks']
+        p4.update(step_name=f'Filling {playlist_title} with {len(choices)} songs you might like')
+        playlist_id = publish_playlist(title=playlist_title, description=playlist_description, tracks=choices, replace=replace_playlist)
+        stage['rows'] = len(choices)
+
+    recommendations['playlist_id'] = playlist_id
+    save_recommendations(recommendations)
+
+STAGES = {
+    'sync': sync,
+    'train': train,
+    'recommend': recommend,
+    'publish': publish,
+    'select': select,
+}
+PIPELINE = ('sync', 'train', 'recommend', 'publish')
+
+def main(playlist_length, username, client_id, client_secret, redirect_uri, width=8, headless=False, metrics_path=None, stages=PIPELINE, profile_every=None,
+         model=MODEL, incremental=False, replace_playlist=REPLACE_PLAYLIST):
+
+    # Profiling is opt-in and sampled: with profile_every=N, one run in N (on average) is profiled into runs/<timestamp>/
+    profiler = Profiler() if Profiler.sampled(profile_every) else None
+    metrics = Metrics(counters=api_counters, labels={'user': username}, profiler=profiler)
+
+    SPConnection().set_all(username, client_id, client_secret, redirect_uri)
+    # A failed stage still closes the database and cache, so nothing carries over into the next run in this process
     try:
-        username = os.environ['SPOTIPY_USERNAME']
-        client_id = os.environ['SPOTIPY_CLIENT_ID']
-        client_secret = os.environ['SPOTIPY_CLIENT_SECRET']
-        redirect_uri = os.environ['SPOTIPY_REDIRECT_URI']
-    except KeyError:
-        print(f"In the future, consider setting the following up as environment variables.\nSee: https://spotipy.readthedocs.io/en/latest/#authorization-code-flow", color='red')
-        username = input('Enter your Spotify username: ', color='yellow')
-        client_id = input('Enter your Spotify Client ID: ', color='yellow')
-        client_secret = input('Enter your Spotify Client Secret: ', color='yellow')
-        redirect_uri = input('Enter your Redirect URI: ', color='yellow')
-
-    main(playlist_length, username, client_id, client_secret, redirect_uri, width=8)
+        # Every stage reads records.db, so it is migrated before whichever of them runs first
+        open_database()
+
+        for stage in stages:
+            STAGES[stage](metrics, playlist_length=playlist_length, width=width, headless=headless,
+                          model=model, incremental=incremental, replace_playlist=replace_playlist)
+
+        # Only stages that talked to Spotify opened the catalog cache
+        cache_stats = SPConnection.cache.stats() if SPConnection.cache else {}
+        for name, value in cache_stats.items():
+            metrics.gauge(f'cache_{name}', value)
+    finally:
+        SPConnection().close_cache()
+        DBConnection().close_connection()
+
+        # Written for failed runs too (the stages that ran), and always stops the tracing it started
+        if profiler:
+            profile_dir = profiler.write(DBConnection().data_path('runs', datetime.now().strftime('%Y%m%d-%H%M%S')))
+            metrics.write(os.path.join(profile_dir, 'metrics.json'))
+
+    if metrics_path:
+        metrics.write(metrics_path)
+    if headless:
+        sys.stdout.write(metrics.to_json() + '\n')
+    else:
+        print(f'Catalog cache: {cache_stats}')
+        print(f'Spotify API: {SPClient.stats}')
+        if profiler:
+            print(f'Stage profiles written to {profile_dir}')
+
+    return metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the whole pipeline with `discoverdaily.py 25`, or one stage at a time')
+    commands = parser.add_subparsers(dest='command')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--headless', action='store_true', default=not sys.stdout.isatty(), help='No progress bars; print run metrics as one JSON line')
+    common.add_argument('--metrics', default=None, help='Write per-stage run metrics to this file (.prom for Prometheus text, else JSON)')
+    common.add_argument('--profile', type=int, default=None, metavar='N', help='Profile CPU and allocations per stage in one run out of N (1 = this run) into runs/<timestamp>/')
+
+    commands.add_parser('run', parents=[common], help='sync, train, recommend and publish').add_argument('playlist_length', nargs='?', help='Number of Tracks to Generate')
+    commands.add_parser('sync', parents=[common], help='Pull your saved and disliked tracks into records.db')
+    commands.add_parser('train', parents=[common], help='Train (or reuse) the classifier on records.db')
+    commands.add_parser('recommend', parents=[common], help='Score new tracks with the saved classifier into recommendations.json').add_argument('playlist_length', nargs='?', help='Number of Tracks to Generate')
+    commands.add_parser('publish', parents=[common], help='Create the playlist from recommendations.json')
+    commands.add_parser('select', parents=[common], help='Cross-validate every candidate model and compare accuracy, fit time and predict latency')
+    for command in ('run', 'publish'):
+        commands.choices[command].add_argument('--new-playlist', action='store_true', help="Create a new playlist instead of replacing the last run's")
+    for command in ('run', 'train'):
+        commands.choices[command].add_argument('--model', default=MODEL, choices=['tree', 'hist_gb', 'knn'], help='Classifier to train (with the parameters select found best)')
+        commands.choices[command].add_argument('--incremental', action='store_true', help='Grow the last model (hist_gb) with the new tracks instead of training from scratch')
+
+    # A bare playlist length (or nothing) still runs the whole pipeline
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in STAGES and argv[0] not in ('run', '-h', '--help'):
+        argv = ['run'] + argv
+    args = parser.parse_args(argv)
+
+    stages = PIPELINE if args.command == 'run' else (args.command,)
+    playlist_length = None
+
+    if 'recommend' in stages:
+        try:
+            playlist_length = int(args.playlist_length)
+
+        except (TypeError, ValueError) as e:
+            print()
+            playlist_length = int(input('Enter The Number of Tracks to Generate: ', default=25, color='yellow'))
+
+    username, client_id, client_secret, redirect_uri = '', '', '', ''
+    if not set(stages) <= {'train', 'select'}:
+        try:
+            username = os.environ['SPOTIPY_USERNAME']
+            client_id = os.environ['SPOTIPY_CLIENT_ID']
+            client_secret = os.environ['SPOTIPY_CLIENT_SECRET']
+            redirect_uri = os.environ['SPOTIPY_REDIRECT_URI']
+        except KeyError:
+            print(f"In the future, consider setting the following up as environment variables.\nSee: https://spotipy.readthedocs.io/en/latest/#authorization-code-flow", color='red')
+            username = input('Enter your Spotify username: ', color='yellow')
+            client_id = input('Enter your Spotify Client ID: ', color='yellow')
+            client_secret = input('Enter your Spotify Client Secret: ', color='yellow')
+            redirect_uri = input('Enter your Redirect URI: ', color='yellow')
+
+    main(playlist_length, username, client_id, client_secret, redirect_uri, width=8, headless=args.headless, metrics_path=args.metrics, stages=stages, profile_every=args.profile,
+         model=getattr(args, 'model', MODEL), incremental=getattr(args, 'incremental', False), replace_playlist=not getattr(args, 'new_playlist', False))
@@ -1,24 +1,177 @@
 import os
 import sys
+import json
+import time
+import heapq
 import argparse
+import traceback
+import multiprocessing
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from utils.utilities import my_print as print
 from utils.utilities import my_input as input
 from utils.utilities import ProgressBar, CountDown, print_json
 
-from discoverdaily import main
+from discoverdaily import main, MODEL, REPLACE_PLAYLIST
+
+# ----------------------------------------------------------------
+
+def load_roster(path, model=MODEL, replace_playlist=REPLACE_PLAYLIST):
+    """
+    A roster is a JSON list of users, e.g.
+        [{"username": "noah", "time": "06:00", "timezone": "America/Denver", "playlist_length": 25, "model": "hist_gb"}]
+
+    client_id, client_secret and redirect_uri default to the SPOTIPY_* environment variables.
+    model and replace_playlist default to the scheduler's --model and --new-playlist.
+    Each user needs a cached OAuth token (.cache-<username>) from one interactive run first.
+    """
+    with open(path) as f:
+        roster = json.load(f)
+
+    for user in roster:
+        user.setdefault('client_id', os.environ.get('SPOTIPY_CLIENT_ID', ''))
+        user.setdefault('client_secret', os.environ.get('SPOTIPY_CLIENT_SECRET', ''))
+        user.setdefault('redirect_uri', os.environ.get('SPOTIPY_REDIRECT_URI', ''))
+        user.setdefault('playlist_length', 25)
+        user.setdefault('time', '06:00')
+        user.setdefault('timezone', 'UTC')
+        user.setdefault('model', model)
+        user.setdefault('replace_playlist', replace_playlist)
+
+    return roster
+
+def next_run(user, now=None):
+    # The next wall-clock occurrence of the user's local run time, as a UTC timestamp
+    zone = ZoneInfo(user['timezone'])
+    now = datetime.fromtimestamp(now or time.time(), zone)
+    hour, minute = (int(part) for part in user['time'].split(':'))
+
+    run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run <= now:
+        run = (run + timedelta(days=1)).replace(hour=hour, minute=minute)
+
+    return run.timestamp()
+
+def init_worker(api_slots):
+    from discoverdaily import SPClient
+    SPClient.global_limit = api_slots
+
+def run_user(user, data_dir, headless, profile_every=None):
+    # The pool gives each run a fresh worker process (max_tasks_per_child=1), so one user's connections, caches and
+    # failures never touch another's; closing them here as well keeps that true should a worker ever be reused
+    from discoverdaily import DBConnection, SPConnection
+
+    user_dir = os.path.join(data_dir, user['username'])
+    os.makedirs(user_dir, exist_ok=True)
+    DBConnection.path = os.path.join(user_dir, 'records.db')
+    SPConnection.cache_path = os.path.join(data_dir, 'cache.db')
+
+    try:
+        metrics = main(user['playlist_length'], user['username'], user['client_id'], user['client_secret'], user['redirect_uri'],
+                       width=16, headless=headless, metrics_path=os.path.join(user_dir, 'metrics.prom'), profile_every=profile_every,
+                       model=user['model'], replace_playlist=user['replace_playlist'])
+    finally:
+        SPConnection().close_cache()
+        DBConnection().close_connection()
+
+    return metrics.to_dict()
+
+def start_pool(workers, api_concurrency):
+    # A worker that dies mid-request never releases its API slot, so every new pool gets a new semaphore.
+    # Workers are spawned (max_tasks_per_child, Python 3.11+, needs it) and the semaphore has to come from the same context
+    context = multiprocessing.get_context('spawn')
+    api_slots = context.BoundedSemaphore(api_concurrency)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, max_tasks_per_child=1, initializer=init_worker, initargs=(api_slots,))
+
+def serve(roster_path, data_dir='data', workers=4, api_concurrency=8, headless=True, profile_every=None,
+          model=MODEL, replace_playlist=REPLACE_PLAYLIST):
+    roster = {user['username']: user for user in load_roster(roster_path, model=model, replace_playlist=replace_playlist)}
+    queue = [(next_run(user), username) for username, user in roster.items()]
+    heapq.heapify(queue)
+
+    pool = start_pool(workers, api_concurrency)
+    running = {}
+
+    def finished(username, future):
+        running.pop(username, None)
+        try:
+            future.result()
+            print(f'{datetime.now().isoformat()} Finished Discover Daily for {username}')
+        except Exception:
+            print(f'{datetime.now().isoformat()} Discover Daily failed for {username}:\n{traceback.format_exc()}', color='red')
+
+    while True:
+        due, username = queue[0]
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(min(wait, 60))
+            continue
+
+        heapq.heapreplace(queue, (next_run(roster[username], now=due + 1), username))
+
+        if username in running:
+            print(f'Skipping {username}: the previous run is still going', color='yellow')
+            continue
+
+        try:
+            future = pool.submit(run_user, roster[username], data_dir, headless, profile_every)
+        except BrokenProcessPool:
+            # Reap the dead pool's processes and queues before replacing it
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = start_pool(workers, api_concurrency)
+            running.clear()
+            future = pool.submit(run_user, roster[username], data_dir, headless, profile_every)
+
+        running[username] = future
+        future.add_done_callback(lambda future, username=username: finished(username, future))
+
+def every(interval, playlist_length, username, client_id, client_secret, redirect_uri, headless=False, metrics_path=None, profile_every=None,
+          model=MODEL, replace_playlist=REPLACE_PLAYLIST):
+    # Each run starts `interval` minutes after the previous one started, so the run time doesn't accumulate as drift
+    start = time.time()
+
+    while True:
+        try:
+            main(playlist_length, username, client_id, client_secret, redirect_uri, width=16, headless=headless, metrics_path=metrics_path,
+                 profile_every=profile_every, model=model, replace_playlist=replace_playlist)
+        except Exception:
+            print(f'{datetime.now().isoformat()} Discover Daily failed:\n{traceback.format_exc()}', color='red')
+
+        start += interval * 60
+        while start < time.time():
+            start += interval * 60
+
+        CountDown(seconds=start - time.time(), message='Restarting in:', completion=(' '*32) + '\n', headless=headless)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('playlist_length', help='Number of Tracks to Generate')
-    parser.add_argument('interval', help='How many minutes there are between iterations')
+    parser.add_argument('playlist_length', nargs='?', help='Number of Tracks to Generate')
+    parser.add_argument('interval', nargs='?', help='How many minutes there are between iterations')
+    parser.add_argument('--headless', action='store_true', default=not sys.stdout.isatty(), help='No progress bars or countdown; print run metrics as one JSON line')
+    parser.add_argument('--metrics', default=None, help='Write per-stage run metrics to this file after each run (.prom for Prometheus text, else JSON)')
+    parser.add_argument('--roster', default=None, help='Serve every user in this JSON roster at their local run time instead of one user on an interval')
+    parser.add_argument('--data-dir', default='data', help='Where each roster user gets their own database, caches and models')
+    parser.add_argument('--workers', type=int, default=4, help='Users generated at the same time')
+    parser.add_argument('--api-concurrency', type=int, default=8, help='Spotify requests in flight across all workers')
+    parser.add_argument('--model', default=MODEL, choices=['tree', 'hist_gb', 'knn'], help='Classifier to train on each run (the default for roster users)')
+    parser.add_argument('--new-playlist', action='store_true', help="Create a new playlist on every run instead of replacing the last run's")
+    parser.add_argument('--profile', type=int, default=None, metavar='N', help='Profile CPU and allocations per stage in one run out of N, into runs/<timestamp>/')
+
+    args = parser.parse_args()
+
+    if args.roster:
+        serve(args.roster, data_dir=args.data_dir, workers=args.workers, api_concurrency=args.api_concurrency, headless=args.headless,
+              profile_every=args.profile, model=args.model, replace_playlist=not args.new_playlist)
+        sys.exit()
 
     try:
-        args = parser.parse_args()
         playlist_length = int(args.playlist_length)
         interval = float(args.interval)
-        
-    except SystemExit as e:
+
+    except (TypeError, ValueError) as e:
         print()
         playlist_length = int(input('Enter The Number of Tracks to Generate: ', default=25, color='yellow'))
         interval = float(input('Enter Interval in Minutes: ', default=1440, color='yellow'))
@@ -35,7 +188,5 @@ if __name__ == '__main__':
         client_secret = input('Enter your Spotify Client Secret: ', color='yellow')
         redirect_uri = input('Enter your Redirect URI: ', color='yellow')
 
-    while True:
-        main(playlist_length, username, client_id, client_secret, redirect_uri, width=16)
-
-        CountDown(minutes=interval, message='Restarting in:', completion=(' '*32) + '\n')
\ No newline at end of file
+    every(interval, playlist_length, username, client_id, client_secret, redirect_uri, headless=args.headless, metrics_path=args.metrics,
+          profile_every=args.profile, model=args.model, replace_playlist=not args.new_playlist)
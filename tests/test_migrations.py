@@ -0,0 +1,80 @@
+import sqlite3
+
+import pytest
+
+import discoverdaily
+from discoverdaily import DBConnection, SCHEMA_VERSION, db_migrate
+
+# records.db as the unversioned app created it: two artist columns per track, DECIMAL features, user_version 0
+BASELINE_SCHEMA = """ CREATE TABLE IF NOT EXISTS tracks (
+                          id TEXT UNIQUE PRIMARY KEY,
+
+                          name TEXT NOT NULL,
+                          artist1 TEXT NOT NULL,
+                          artist1ID TEXT NOT NULL,
+                          artist2 TEXT,
+                          artist2ID TEXT,
+                          popularity INTEGER NOT NULL,
+                          liked BOOLEAN NOT NULL,
+
+                          acousticness DECIMAL(1, 5) NOT NULL,
+                          danceability DECIMAL(1, 5) NOT NULL,
+                          duration_ms  INTEGER NOT NULL,
+                          energy DECIMAL(1, 5) NOT NULL,
+                          instrumentalness DECIMAL(1, 5) NOT NULL,
+                          key INTEGER NOT NULL,
+                          liveness DECIMAL(1, 5) NOT NULL,
+                          loudness INTEGER NOT NULL,
+                          mode INTEGER NOT NULL,
+                          speechiness DECIMAL(1, 5) NOT NULL,
+                          valence DECIMAL(1, 5) NOT NULL,
+                          tempo INTEGER NOT NULL,
+                          time_signature INTEGER NOT NULL
+                      );
+                  """
+
+BASELINE_TRACKS = [
+    ('track1', 'Duet', 'Artist A', 'artistA', 'Artist B', 'artistB', 50, 1,
+     0.1, 0.8, 200000, 0.7, 0.0, 5, 0.1, -6, 1, 0.05, 0.9, 120, 4),
+    ('track2', 'Solo', 'Artist A', 'artistA', None, None, 30, 0,
+     0.5, 0.4, 180000, 0.3, 0.2, 2, 0.3, -9, 0, 0.04, 0.2, 95, 3),
+]
+
+@pytest.fixture
+def baseline_db(tmp_path, monkeypatch):
+    path = tmp_path / 'records.db'
+    db = sqlite3.connect(path)
+    db.execute(BASELINE_SCHEMA)
+    db.executemany(f'INSERT INTO tracks VALUES({", ".join("?" * 21)})', BASELINE_TRACKS)
+    db.commit()
+    db.close()
+
+    monkeypatch.setattr(DBConnection, 'path', str(path))
+    DBConnection().close_connection()
+    yield path
+    DBConnection().close_connection()
+
+def test_migrates_baseline_schema(baseline_db):
+    assert db_migrate() == SCHEMA_VERSION
+
+    db = sqlite3.connect(baseline_db)
+    assert db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+
+    columns = ', '.join(['id', 'name', 'popularity', 'liked'] + discoverdaily.FEATURE_COLUMNS)
+    assert db.execute(f'SELECT {columns} FROM tracks ORDER BY rowid').fetchall() == [
+        ('track1', 'Duet', 50, 1, 0.1, 0.8, 200000, 0.7, 0.0, 5, 0.1, -6.0, 1, 0.05, 0.9, 120.0, 4),
+        ('track2', 'Solo', 30, 0, 0.5, 0.4, 180000, 0.3, 0.2, 2, 0.3, -9.0, 0, 0.04, 0.2, 95.0, 3),
+    ]
+    assert db.execute('SELECT id, name FROM artists ORDER BY id').fetchall() == [('artistA', 'Artist A'), ('artistB', 'Artist B')]
+    assert db.execute('SELECT track_id, artist_id, position FROM track_artists ORDER BY track_id, position').fetchall() == [
+        ('track1', 'artistA', 0), ('track1', 'artistB', 1), ('track2', 'artistA', 0),
+    ]
+    db.close()
+
+def test_migrate_is_idempotent(baseline_db):
+    db_migrate()
+    assert db_migrate() == SCHEMA_VERSION
+
+    db = sqlite3.connect(baseline_db)
+    assert db.execute('SELECT count(*) FROM track_artists').fetchone()[0] == 3
+    db.close()
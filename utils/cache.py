@@ -0,0 +1,115 @@
+import json
+import sqlite3
+import threading
+import time
+
+class TTLCache:
+    """
+    A persistent, size-bounded key/value cache backed by SQLite.
+
+    Usage: Create a TTLCache object
+           Call get with a namespace, a key and a function that fetches the value on a miss
+           Concurrent misses for the same key share a single call to fetch
+    Args: path (database file), ttl (seconds per namespace), max_entries (least recently used entries are evicted past this)
+    Returns: get returns the cached (or freshly fetched) JSON-serializable value
+    """
+
+    def __init__(self, path='cache.db', ttl=None, max_entries=50000, default_ttl=24*60*60):
+        self.path = path
+        self.ttl = dict(ttl or {})
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.inserts = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('PRAGMA busy_timeout = 5000')
+        with self.db:
+            self.db.execute(""" CREATE TABLE IF NOT EXISTS cache (
+                                    namespace TEXT NOT NULL,
+                                    key TEXT NOT NULL,
+                                    value TEXT NOT NULL,
+                                    fetched_at REAL NOT NULL,
+                                    used_at REAL NOT NULL,
+                                    PRIMARY KEY (namespace, key)
+                                );
+                            """)
+            self.db.execute('CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at)')
+
+    def get(self, namespace, key, fetch):
+        now = time.time()
+        ttl = self.ttl.get(namespace, self.default_ttl)
+
+        with self.lock:
+            row = self.db.execute('SELECT value, fetched_at FROM cache WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+
+            if row and now - row[1] < ttl:
+                self.hits += 1
+                with self.db:
+                    self.db.execute('UPDATE cache SET used_at = ? WHERE namespace = ? AND key = ?', (now, namespace, key))
+                return json.loads(row[0])
+
+            # Single-flight: the first thread to miss fetches, later ones wait for its result
+            flight = self.in_flight.get((namespace, key))
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[(namespace, key)] = {'done': threading.Event()}
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['value']
+
+        try:
+            value = fetch()
+            flight['value'] = value
+            self.put(namespace, key, value)
+            return value
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[(namespace, key)]
+            flight['done'].set()
+
+    def put(self, namespace, key, value):
+        now = time.time()
+
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO cache (namespace, key, value, fetched_at, used_at) VALUES(?, ?, ?, ?, ?)',
+                                (namespace, key, json.dumps(value), now, now))
+
+            self.inserts += 1
+            if self.inserts % 100 == 0:
+                self.evict()
+
+    def evict(self):
+        with self.db:
+            cursor = self.db.execute(""" DELETE FROM cache WHERE rowid IN (
+                                            SELECT rowid FROM cache ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                                         )
+                                     """, (self.max_entries,))
+        self.evictions += cursor.rowcount
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'evictions': self.evictions}
+
+    def close(self):
+        with self.lock:
+            self.evict()
+            self.db.close()
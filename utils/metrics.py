@@ -0,0 +1,79 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+class Metrics:
+    """
+    Per-stage run metrics: wall time, rows processed and the change in any external counters.
+
+    Usage: Create a Metrics object, optionally with a function returning counters to track (e.g. API calls)
+           Wrap each stage in `with metrics.stage('sync') as stage:` and set stage['rows'] inside it (repeats accumulate)
+           Export with to_json, to_prometheus or write
+    Args: counters (function returning a dict of monotonically increasing counts), labels (added to every sample),
+          profiler (optional utils.profiling.Profiler; every stage is then also CPU and allocation profiled)
+    """
+
+    def __init__(self, counters=None, labels=None, profiler=None):
+        self.counters = counters or dict
+        self.labels = dict(labels or {})
+        self.profiler = profiler
+        self.stages = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        # Entering the same stage again (e.g. once per micro-batch) adds to its totals
+        before = dict(self.counters())
+        record = {'rows': 0}
+        start = time.perf_counter()
+
+        try:
+            with self.profiler.stage(name) if self.profiler else nullcontext():
+                yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            for counter, value in self.counters().items():
+                record[counter] = value - before.get(counter, 0)
+
+            previous = self.stages.get(name, {})
+            self.stages[name] = {key: round(previous.get(key, 0) + value, 6) for key, value in record.items()}
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def to_dict(self):
+        return {
+            'labels': self.labels,
+            'started': self.started,
+            'seconds': round(sum(stage['seconds'] for stage in self.stages.values()), 6),
+            'stages': self.stages,
+            'gauges': self.gauges,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def to_prometheus(self, prefix='discoverdaily'):
+        lines = []
+        labels = ','.join(f'{key}="{value}"' for key, value in sorted(self.labels.items()))
+
+        metrics = sorted({metric for stage in self.stages.values() for metric in stage})
+        for metric in metrics:
+            name = f'{prefix}_stage_{metric}'
+            lines.append(f'# TYPE {name} gauge')
+            for stage, record in self.stages.items():
+                if metric in record:
+                    stage_labels = ','.join(filter(None, [labels, f'stage="{stage}"']))
+                    lines.append(f'{name}{{{stage_labels}}} {record[metric]}')
+
+        for gauge, value in sorted(self.gauges.items()):
+            name = f'{prefix}_{gauge}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json() + '\n')
@@ -0,0 +1,88 @@
+import io
+import os
+import random
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+class Profiler:
+    """
+    CPU and allocation profiles for each stage of a run.
+
+    Usage: Create a Profiler and pass it to Metrics(profiler=...); every metrics stage is then profiled
+           (repeated stages accumulate) and write(directory) leaves, per stage, <stage>.prof (cProfile/pstats),
+           <stage>.txt (top functions) and <stage>.allocations.txt (top allocation sites), then stops tracemalloc
+           cProfile only sees the calling thread; time spent waiting on worker threads shows up as waits
+    Args: top (lines kept in each report), frames (traceback depth kept by tracemalloc; more is slower)
+    """
+
+    def __init__(self, top=30, frames=1):
+        self.top = top
+        self.frames = frames
+        self.profiles = {}
+        self.allocations = {}
+        self.peaks = {}
+        self.started_tracing = False
+
+    @staticmethod
+    def sampled(every):
+        # True for one run in `every` on average (every=1 profiles every run, None or 0 never does)
+        return bool(every) and random.random() < 1 / every
+
+    @contextmanager
+    def stage(self, name):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        profile.enable()
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            after = tracemalloc.take_snapshot()
+            self.peaks[name] = max(self.peaks.get(name, 0), tracemalloc.get_traced_memory()[1])
+
+            allocations = self.allocations.setdefault(name, {})
+            for stat in after.compare_to(before, 'lineno'):
+                if stat.size_diff or stat.count_diff:
+                    site = str(stat.traceback)
+                    size, count = allocations.get(site, (0, 0))
+                    allocations[site] = (size + stat.size_diff, count + stat.count_diff)
+
+    def report(self, name):
+        out = io.StringIO()
+        pstats.Stats(self.profiles[name], stream=out).sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+    def allocation_report(self, name):
+        lines = [f'peak traced memory: {self.peaks.get(name, 0) / 1024:.1f} KiB', 'net allocations by site (KiB, blocks):']
+        sites = sorted(self.allocations.get(name, {}).items(), key=lambda item: abs(item[1][0]), reverse=True)
+        for site, (size, count) in sites[:self.top]:
+            lines.append(f'{size / 1024:>12.1f} {count:>9}  {site}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(directory, f'{name}.prof'))
+                with open(os.path.join(directory, f'{name}.txt'), 'w') as f:
+                    f.write(self.report(name))
+                with open(os.path.join(directory, f'{name}.allocations.txt'), 'w') as f:
+                    f.write(self.allocation_report(name))
+        finally:
+            self.stop()
+
+        return directory
+
+    def stop(self):
+        # Stops tracemalloc if this profiler started it; the profiles collected so far are kept
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
@@ -0,0 +1,93 @@
+import threading
+import time
+
+class TokenBucket:
+    """
+    A thread-safe token bucket.
+
+    Usage: Create a TokenBucket object
+           Call acquire before each request; it blocks until a token is available
+           Call pause when the server asks for a break (Retry-After); every caller then waits it out
+    Args: rate (tokens added per second), capacity (largest burst allowed)
+    """
+
+    def __init__(self, rate=10, capacity=20):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.not_before = self.updated
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.not_before:
+                    wait = self.not_before - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # No tokens until `seconds` from now, and none saved up meanwhile, so the callers don't all burst back at once
+        with self.lock:
+            self.not_before = max(self.not_before, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.not_before
+
+class AdaptiveLimiter:
+    """
+    A concurrency limit that adapts to throttling (additive increase, multiplicative decrease).
+
+    Usage: Use as a context manager around each request
+           Call throttled when the server pushes back; the limit halves, once per burst of throttles
+           (pass the time the request started, and requests already in flight at the last decrease don't halve it again)
+           Every `increase_after` successes in a row raise the limit by one, up to `maximum`
+    Args: initial, minimum and maximum number of requests in flight
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, increase_after=20):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase_after = increase_after
+        self.in_flight = 0
+        self.successes = 0
+        self.decreased = float('-inf')
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def succeeded(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.increase_after and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def throttled(self, started=None):
+        with self.condition:
+            if started is not None and started < self.decreased:
+                return
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
+            self.decreased = time.monotonic()
@@ -76,23 +76,32 @@ class ProgressBar:
 
     Usage: Create a ProgressBar object
            Before or After each checkpoint, call update with the checkpoint name
-    Args: name. steps (nuber of checkpoints), width (amount of '-' characters)
+    Args: name. steps (nuber of checkpoints), width (amount of '-' characters),
+          animate (sweep the bar; adds a short sleep per column), headless (draw nothing, e.g. under a scheduler)
     Returns:
     """
     
-    def __init__(self, name='Progress', steps=3, width=48, completion='Complete'):
+    def __init__(self, name='Progress', steps=3, width=48, completion='Complete', animate=True, headless=False):
         self.name = name
         self.steps = steps
         self.width = width
         self.completion = completion
+        self.animate = animate
+        self.headless = headless
         self.cur_step = 0
         self.last_label = ''
 
+        if self.headless:
+            return
+
         print('\n' + name)
         print('[' + ' '*self.width + ']', end='\r', flush=True)
 
     def update(self, step_name, color='yellow'):
         self.cur_step += 1
+        if self.headless:
+            return
+
         self.draw_bar(step_name, color)
 
         if self.cur_step == self.steps:
@@ -109,8 +118,9 @@ class ProgressBar:
         previous = int(width - (self.width / self.steps))
         width = width - previous
 
-        for i in range(width + 1):
-            time.sleep(0.05)
+        for i in range(width + 1) if self.animate else [width]:
+            if self.animate:
+                time.sleep(0.05)
 
             label = step_name + (' ' * (len(self.last_label) - len(step_name)))
             bar = FOREGROUND[color] + ('-' * (previous + i)) + (' ' * (self.width - (previous + i))) + STYLES['reset']
@@ -132,7 +142,7 @@ def test_progBar():
     p.update('Sending Email')
 
 class CountDown:
-    def __init__(self, seconds=0, minutes=0, hours=0, show_milli=False, message='', completion='None', color='yellow', ccolor='green'):
+    def __init__(self, seconds=0, minutes=0, hours=0, show_milli=False, message='', completion='None', color='yellow', ccolor='green', headless=False):
         self.seconds = seconds
         self.minutes = minutes
         self.hours = hours
@@ -144,6 +154,10 @@ class CountDown:
         delta = datetime.timedelta(hours=self.hours, minutes=self.minutes, seconds=self.seconds)
         total_seconds = int(delta.total_seconds())
 
+        # Nothing to show, so wait out the whole interval at once
+        if headless:
+            time.sleep(delta.total_seconds())
+            return
 
         while total_seconds > 1:
             total_seconds -= 1